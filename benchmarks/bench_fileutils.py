@@ -0,0 +1,260 @@
+#!/usr/bin/python
+"""Benchmarks for the fileutils functions every install goes through
+
+Generates a synthetic install tree, times match(), match_list(), glob(),
+walk(), copy() and copy_files() on it, and writes the results as JSON.
+Results of two runs (e.g. of two commits) can be compared with --compare.
+
+Example:
+    python benchmarks/bench_fileutils.py --files 100000 --layout deep -o new.json --compare old.json
+"""
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import random
+import platform
+import tempfile
+import subprocess
+import optparse
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows
+    resource = None
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..")))
+from clbundler import fileutils
+
+#what formulas typically install, and what they exclude
+INSTALL_PATTERNS = ["include/**/*.h", "include/**/*.hpp", "lib/*.a", "lib/*.so*",
+                    "lib/**/*.lib", "bin/*.dll", "bin/*.exe", "share/**"]
+EXCLUDE_PATTERNS = ["**/test/**", "**/*.pyc", "**/.git/**", "**/CMakeFiles/**",
+                    "share/doc/**", "**/*.la"]
+
+_top_dirs = ["include", "lib", "bin", "share", "src"]
+_sub_dirs = ["core", "util", "test", "detail", "io", "CMakeFiles", "doc", "impl"]
+_extensions = [".h", ".hpp", ".c", ".a", ".so", ".la", ".dll", ".txt", ".pyc", ".lib"]
+
+def generate_tree(root, num_files, layout, symlink_ratio, seed=0):
+    """Create num_files files under root and return their paths relative to root
+    
+    layout is "wide" (few levels, many files per directory) or "deep" (long
+    chains of nested directories). About symlink_ratio of the files are
+    symbolic links to other files.
+    """
+    rand = random.Random(seed)
+    if layout == "wide":
+        files_per_dir, max_depth = 500, 2
+    else:
+        files_per_dir, max_depth = 10, 12
+    
+    paths = []
+    dirs = []
+    while len(paths) < num_files:
+        depth = rand.randint(1, max_depth)
+        parts = [rand.choice(_top_dirs)] + [rand.choice(_sub_dirs) + str(rand.randint(0, 3))
+                                            for i in range(depth - 1)]
+        d = os.path.join(*parts)
+        fileutils.makedirs(os.path.join(root, d), exist_ok=True)
+        dirs.append(d)
+        
+        for i in range(min(files_per_dir, num_files - len(paths))):
+            name = "f{0}{1}".format(len(paths), rand.choice(_extensions))
+            path = os.path.join(d, name)
+            full_path = os.path.join(root, path)
+            if paths and hasattr(os, "symlink") and rand.random() < symlink_ratio:
+                target = os.path.join(root, rand.choice(paths))
+                os.symlink(os.path.relpath(target, os.path.dirname(full_path)), full_path)
+            else:
+                with open(full_path, "wb") as f:
+                    f.write(path.encode("utf-8") * rand.randint(1, 64))
+            paths.append(path)
+    
+    #a few links to directories, which walk() and copy() must not follow
+    if hasattr(os, "symlink"):
+        for i, d in enumerate(rand.sample(dirs, min(10, len(dirs)))):
+            link = os.path.join(root, "dirlink{0}".format(i))
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(root, d), link)
+    
+    return paths
+
+def peak_memory_kb():
+    """Return the peak resident memory of this process in KiB, or None if unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        #bytes on mac, KiB elsewhere
+        rss //= 1024
+    return rss
+
+def run_benchmark(name, func, repeat):
+    """Call func() repeat times and return the result of the fastest run
+    
+    func returns the number of operations it did.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        ops = func()
+        elapsed = max(time.time() - start, 1e-9)
+        if best is None or elapsed < best[1]:
+            best = (ops, elapsed)
+    
+    ops, elapsed = best
+    result = {"name":name, "ops":ops, "seconds":round(elapsed, 6),
+              "ops_per_sec":round(ops / elapsed, 1), "peak_memory_kb":peak_memory_kb()}
+    print("{0:<28} {1:>10} ops {2:>10.3f}s {3:>14.1f} ops/s".format(
+          name, ops, elapsed, ops / elapsed))
+    return result
+
+def benchmarks(root, paths, work_dir, workers):
+    """Return a list of (name, func) for the tree at root"""
+    abs_paths = [os.path.join(root, p) for p in paths]
+    install_patterns = [os.path.join(root, p) for p in INSTALL_PATTERNS]
+    exclude_patterns = [os.path.join(root, p) for p in EXCLUDE_PATTERNS]
+    copy_dest = os.path.join(work_dir, "copy")
+    
+    def _match():
+        for path in abs_paths:
+            for pattern in install_patterns:
+                fileutils.match(path, pattern)
+        return len(abs_paths) * len(install_patterns)
+    
+    def _match_list():
+        for path in abs_paths:
+            fileutils.match_list(path, exclude_patterns)
+        return len(abs_paths)
+    
+    def _glob(patterns, exclude=None):
+        def _run():
+            n = 0
+            for pattern in patterns:
+                for path in fileutils.glob(os.path.join(root, pattern), exclude):
+                    n += 1
+            return n
+        return _run
+    
+    def _walk(entries):
+        def _run():
+            n = 0
+            for dirpath, dirs, files in fileutils.walk(root, follow_links=False, entries=entries):
+                n += len(dirs) + len(files)
+            return n
+        return _run
+    
+    def _copytree():
+        if os.path.exists(copy_dest):
+            fileutils.remove(copy_dest)
+        fileutils.copy(root, copy_dest, ignore=fileutils.copy_ignore(exclude_patterns))
+        return len(paths)
+    
+    def _copy_files(mode):
+        def _run():
+            if os.path.exists(copy_dest):
+                fileutils.remove(copy_dest)
+            pairs = [(os.path.join(root, p), os.path.join(copy_dest, p)) for p in paths]
+            for d in set(os.path.dirname(dest) for src, dest in pairs):
+                fileutils.makedirs(d, exist_ok=True)
+            for result in fileutils.copy_files(pairs, workers, mode):
+                pass
+            return len(pairs)
+        return _run
+    
+    return [("match", _match),
+            ("match_list", _match_list),
+            ("glob", _glob(["lib/*", "bin/*", "*/*"])),
+            ("glob_doublestar", _glob(INSTALL_PATTERNS)),
+            ("glob_doublestar_exclude", _glob(INSTALL_PATTERNS, exclude_patterns)),
+            ("walk", _walk(False)),
+            ("walk_entries", _walk(True)),
+            ("copytree", _copytree),
+            ("copy_files", _copy_files("copy")),
+            ("copy_files_hardlink", _copy_files("hardlink"))]
+
+def git_commit():
+    try:
+        output = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    except OSError:
+        return None
+    return output.decode("ascii").strip() or None
+
+def compare(old_path, results):
+    """Print the ops/s of results relative to the results saved in old_path"""
+    with open(old_path, "r") as f:
+        old = dict((r["name"], r) for r in json.load(f)["results"])
+    
+    print("\nCompared to {0}:".format(old_path))
+    for r in results:
+        if r["name"] in old and old[r["name"]]["ops_per_sec"]:
+            ratio = r["ops_per_sec"] / old[r["name"]]["ops_per_sec"]
+            print("{0:<28} {1:>8.2f}x".format(r["name"], ratio))
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]", description=__doc__.split("\n")[0])
+    parser.add_option("-n", "--files", dest="files", type="int", default=10000,
+                      help="Number of files in the generated tree [default: %default]")
+    parser.add_option("--layout", dest="layout", choices=("wide", "deep"), default="wide",
+                      help="Shape of the generated tree {wide, deep} [default: %default]")
+    parser.add_option("--symlinks", dest="symlinks", type="float", default=0.05,
+                      help="Fraction of files that are symbolic links [default: %default]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Runs of each benchmark, the fastest is reported [default: %default]")
+    parser.add_option("-j", "--workers", dest="workers", type="int", default=8,
+                      help="Threads used by copy_files() [default: %default]")
+    parser.add_option("-b", "--benchmark", dest="only", action="append", default=[],
+                      help="Only run this benchmark (can be repeated)")
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write the results to this JSON file")
+    parser.add_option("--compare", dest="compare",
+                      help="Compare with the results in this JSON file")
+    parser.add_option("--dir", dest="work_dir",
+                      help="Directory for the generated files (a temporary directory by default)")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="Seed for generating the tree [default: %default]")
+    options, args = parser.parse_args()
+    
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="clbundler-bench-")
+    root = os.path.join(work_dir, "tree")
+    try:
+        start = time.time()
+        if os.path.exists(root):
+            fileutils.remove(root)
+        paths = generate_tree(root, options.files, options.layout, options.symlinks, options.seed)
+        print("Generated {0} files ({1} layout) in {2:.1f}s\n".format(
+              len(paths), options.layout, time.time() - start))
+        
+        results = []
+        for name, func in benchmarks(root, paths, work_dir, options.workers):
+            if not options.only or name in options.only:
+                results.append(run_benchmark(name, func, options.repeat))
+    finally:
+        if options.work_dir:
+            fileutils.remove(root)
+            copy_dest = os.path.join(work_dir, "copy")
+            if os.path.exists(copy_dest):
+                fileutils.remove(copy_dest)
+        else:
+            fileutils.remove(work_dir)
+    
+    report = {"commit":git_commit(),
+              "python":platform.python_version(),
+              "platform":platform.platform(),
+              "params":{"files":options.files, "layout":options.layout,
+                        "symlinks":options.symlinks, "repeat":options.repeat,
+                        "workers":options.workers, "seed":options.seed},
+              "results":results}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        compare(options.compare, results)
+
+if __name__ == "__main__":
+    main()
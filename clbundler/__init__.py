@@ -4,6 +4,7 @@ from clbundler.config import global_config
 from clbundler.commandparser import CommandParser
 from clbundler import cli
 from clbundler import exceptions
+from clbundler import trash
 
 def main():
     logger = logging.getLogger()
@@ -18,7 +19,12 @@ def main():
     parser = CommandParser()
     cli.setup_parser(parser)
     
+    #deletes leftovers from an earlier run in the background
+    trash.workspace_trash()
+    
     try:
         parser.parse_args()
     except exceptions.CLbundlerError as e:
         logger.error(e)
+    finally:
+        trash.wait()
@@ -0,0 +1,408 @@
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import urllib2
+import urlparse
+import hashlib
+import logging
+import tarfile
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import config
+import exceptions
+import fileutils
+from fileset import Categories, FileSet, category_name
+
+#changes whenever the layout of cache entries or the fingerprint changes
+FORMAT_VERSION = 1
+
+_archive_ext = ".tar.gz"
+_metadata_ext = ".json"
+
+def local_cache():
+    """Return the BuildCache configured in the global config, or None if it is disabled"""
+    max_size = config.global_config().build_cache_size()
+    if not max_size:
+        return None
+    
+    remote = None
+    if config.global_config().build_cache_remote():
+        remote = remote_backend(config.global_config().build_cache_remote())
+    #builds change the current directory, and the configured path may be relative
+    return BuildCache(os.path.abspath(config.global_config().build_cache_dir()), max_size,
+                      remote, config.global_config().build_cache_upload())
+
+def remote_backend(location):
+    """Return the backend for a shared cache at location, an http(s):// or file:// URL or a path"""
+    scheme = urlparse.urlparse(location).scheme
+    if scheme in ("http", "https"):
+        return HttpBackend(location)
+    if scheme == "file":
+        return FileSystemBackend(urllib2.url2pathname(urlparse.urlparse(location).path))
+    return FileSystemBackend(location)
+
+def fingerprint(formula, context, patch_files, dep_fingerprints):
+    """Return a hex digest of everything that affects what formula.build() produces
+    
+    That is the formula file, the patches, the source, the formula options, the
+    toolchain and architecture, and the fingerprints of the dependencies
+    (dep_fingerprints maps each dependency name to its fingerprint).
+    """
+    inputs = {"format":FORMAT_VERSION,
+              "name":formula.name,
+              "version":getattr(formula, "version", None),
+              "formula":fileutils.file_digest(formula.file),
+              "patches":[[os.path.basename(p), fileutils.file_digest(p)] for p in patch_files],
+              "source":getattr(formula, "source", None),
+              "options":formula.option_values(),
+              "os":context.os_name,
+              "toolchain":context.toolchain,
+              "arch":context.arch,
+              "depends_on":dep_fingerprints}
+    #options can be anything, repr() is stable enough for the usual str/bool/list values
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=repr)).hexdigest()
+
+class BuildCache(object):
+    """A directory of finished builds, keyed by fingerprint()
+    
+    An entry is a tar archive of every file a build installs, stored under
+    <category>/<destination>, and a JSON file with information about the build.
+    Restoring an entry extracts the archive and returns a FileSet that installs
+    the same files as the original build. When the cache grows over max_size
+    bytes, the entries that were used least recently are deleted.
+    
+    With a remote backend, entries that are not in the directory are downloaded
+    from the remote cache, and new entries are uploaded to it if upload is true.
+    Downloads are checked against the SHA-256 digest in the entry's metadata.
+    """
+    def __init__(self, path, max_size, remote=None, upload=True):
+        self.path = path
+        self.max_size = max_size
+        self.remote = remote
+        self.upload = upload
+        #keys that could not be downloaded, they are not requested again
+        self._not_fetched = set()
+    
+    def get(self, key, dest_dir):
+        """Extract the entry for key into dest_dir and return a FileSet for it
+        
+        Returns None if there is no entry for key. A damaged entry is deleted.
+        """
+        archive = self._archive_path(key)
+        if not os.path.isfile(archive) and not self.fetch(key):
+            return None
+        
+        try:
+            _extract(archive, dest_dir)
+        except (exceptions.BuildCacheError, tarfile.TarError, EnvironmentError, EOFError) as e:
+            logging.getLogger().warning("Ignoring damaged build cache entry {0}: {1}".format(key, e))
+            self.remove(key)
+            return None
+        
+        #the modification time of the archive is the last time it was used
+        try:
+            os.utime(archive, None)
+        except OSError:
+            pass
+        
+        fileset = FileSet()
+        for category in Categories:
+            category_dir = os.path.join(dest_dir, category_name(category))
+            if os.path.isdir(category_dir):
+                fileset.add([os.path.join(category_dir, "*")], "", category=category)
+        return fileset
+    
+    def put(self, key, fileset, metadata={}):
+        """Store the files installed by fileset as the entry for key
+        
+        metadata is saved along with the entry. Returns the path of the archive.
+        Raises BuildCacheError if get() could not restore the files, e.g. 
+        because of a symbolic link to an absolute path.
+        """
+        fileutils.makedirs(self.path, exist_ok=True)
+        plan = fileset.resolve()
+        
+        #write to a temporary file first, so that nobody sees a partial archive
+        fd, tmp_path = tempfile.mkstemp(_archive_ext + ".tmp", key, self.path)
+        os.close(fd)
+        try:
+            tar = tarfile.open(tmp_path, "w:gz", compresslevel=6)
+            try:
+                #directories are not categorized, copying them with the run files
+                #creates them in the bundle
+                for d in plan.dirs:
+                    info = tarfile.TarInfo(os.path.join(category_name(Categories.run), d))
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    info.mtime = time.time()
+                    tar.addfile(info)
+                for src, dest, category in plan.files:
+                    info = tar.gettarinfo(src, os.path.join(category_name(category), dest))
+                    #_extract() refuses these, the entry could never be used
+                    _check_member(info)
+                    if info.isreg():
+                        with open(src, "rb") as f:
+                            tar.addfile(info, f)
+                    else:
+                        tar.addfile(info)
+            finally:
+                tar.close()
+            
+            archive = self._archive_path(key)
+            _replace(tmp_path, archive)
+        except:
+            os.remove(tmp_path)
+            raise
+        
+        metadata = dict(metadata)
+        metadata.update({"key":key, "format":FORMAT_VERSION, "created":time.time(),
+                         "files":len(plan.files), "size":os.path.getsize(archive),
+                         "sha256":fileutils.file_digest(archive)})
+        tmp_path = self._metadata_path(key) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        _replace(tmp_path, self._metadata_path(key))
+        
+        if self.remote is not None and self.upload:
+            try:
+                #the metadata goes last, an entry without it does not exist
+                self.remote.put(key + _archive_ext, archive)
+                self.remote.put(key + _metadata_ext, self._metadata_path(key))
+            except (exceptions.BuildCacheError, EnvironmentError) as e:
+                logging.getLogger().warning("Could not upload {0} to {1}: {2}".format(key, self.remote, e))
+        
+        self.evict(keep=key)
+        return archive
+    
+    def fetch(self, key):
+        """Download the entry for key from the remote cache, return True if it was found
+        
+        A download that does not match its digest is discarded. Keys that were
+        missing or damaged are only requested once.
+        """
+        if self.remote is None or key in self._not_fetched:
+            return False
+        
+        fileutils.makedirs(self.path, exist_ok=True)
+        fd, tmp_metadata = tempfile.mkstemp(_metadata_ext + ".tmp", key, self.path)
+        os.close(fd)
+        fd, tmp_archive = tempfile.mkstemp(_archive_ext + ".tmp", key, self.path)
+        os.close(fd)
+        try:
+            if not self.remote.get(key + _metadata_ext, tmp_metadata):
+                self._not_fetched.add(key)
+                return False
+            with open(tmp_metadata, "r") as f:
+                digest = json.load(f).get("sha256")
+            if not self.remote.get(key + _archive_ext, tmp_archive):
+                self._not_fetched.add(key)
+                return False
+            if fileutils.file_digest(tmp_archive) != digest:
+                raise exceptions.BuildCacheError("digest does not match")
+            
+            _replace(tmp_archive, self._archive_path(key))
+            _replace(tmp_metadata, self._metadata_path(key))
+            logging.getLogger().info("Downloaded {0} from {1}".format(key, self.remote))
+            return True
+        except (exceptions.BuildCacheError, EnvironmentError, ValueError) as e:
+            logging.getLogger().warning("Could not download {0} from {1}: {2}".format(key, self.remote, e))
+            self._not_fetched.add(key)
+            return False
+        finally:
+            for path in (tmp_metadata, tmp_archive):
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    def prefetch(self, keys, workers=4):
+        """Download the entries for keys that are only in the remote cache, workers at a time"""
+        if self.remote is None:
+            return
+        missing = [k for k in set(keys) if not os.path.isfile(self._archive_path(k))]
+        if not missing:
+            return
+        
+        pool = ThreadPool(min(workers, len(missing)))
+        try:
+            pool.map(self.fetch, missing)
+        finally:
+            pool.close()
+            pool.join()
+        self.evict()
+    
+    def metadata(self, key):
+        """Return the metadata stored with the entry for key, or None"""
+        try:
+            with open(self._metadata_path(key), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+    
+    def remove(self, key):
+        for path in (self._archive_path(key), self._metadata_path(key)):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    
+    def evict(self, keep=None):
+        """Delete the least recently used entries until the cache fits in max_size"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(_archive_ext):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, name[:-len(_archive_ext)], st.st_size))
+                total += st.st_size
+        
+        entries.sort()
+        for mtime, key, size in entries:
+            if total <= self.max_size:
+                break
+            if key != keep:
+                logging.getLogger().debug("Removing {0} from the build cache".format(key))
+                self.remove(key)
+                total -= size
+    
+    def _archive_path(self, key):
+        return os.path.join(self.path, key + _archive_ext)
+    
+    def _metadata_path(self, key):
+        return os.path.join(self.path, key + _metadata_ext)
+
+class FileSystemBackend(object):
+    """A shared cache in a directory, e.g. on a network share"""
+    def __init__(self, path):
+        self.path = path
+    
+    def __str__(self):
+        return self.path
+    
+    def get(self, name, dest_path):
+        """Copy the file name to dest_path, return False if there is no such file"""
+        try:
+            shutil.copyfile(os.path.join(self.path, name), dest_path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+    
+    def put(self, name, src_path):
+        fileutils.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(".tmp", name, self.path)
+        os.close(fd)
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            _replace(tmp_path, os.path.join(self.path, name))
+        except:
+            os.remove(tmp_path)
+            raise
+
+class HttpBackend(object):
+    """A shared cache on a web server that supports GET and PUT, e.g. cacheserver.py"""
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/") + "/"
+        self.timeout = timeout
+    
+    def __str__(self):
+        return self.url
+    
+    def get(self, name, dest_path):
+        """Download name to dest_path, return False if the server does not have it"""
+        try:
+            response = urllib2.urlopen(self.url + name, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise exceptions.BuildCacheError("GET {0}: {1}".format(name, e))
+        try:
+            with open(dest_path, "wb") as f:
+                shutil.copyfileobj(response, f)
+        finally:
+            response.close()
+        return True
+    
+    def put(self, name, src_path):
+        with open(src_path, "rb") as f:
+            request = urllib2.Request(self.url + name, f, 
+                                      {"Content-Type":"application/octet-stream",
+                                       "Content-Length":str(os.fstat(f.fileno()).st_size)})
+            request.get_method = lambda: "PUT"
+            try:
+                urllib2.urlopen(request, timeout=self.timeout).close()
+            except urllib2.HTTPError as e:
+                raise exceptions.BuildCacheError("PUT {0}: {1}".format(name, e))
+
+def _extract(archive, dest_dir):
+    """Extract archive into dest_dir, refusing members that would end up outside of it
+    
+    Entries can come from a remote cache, so besides the member names, link
+    targets are checked, and every member is checked against what the members
+    before it created: a symbolic link that was extracted earlier must not 
+    lead a later member out of dest_dir.
+    """
+    root = os.path.realpath(dest_dir)
+    tar = tarfile.open(archive, "r:*")
+    try:
+        for m in tar.getmembers():
+            _check_member(m)
+            
+            path = os.path.normpath(m.name)
+            parent = os.path.realpath(os.path.join(root, os.path.dirname(path)))
+            if not _is_below(parent, root):
+                raise exceptions.BuildCacheError("{0} is outside the archive".format(m.name))
+            if m.issym():
+                target = os.path.join(parent, m.linkname)
+            elif m.islnk():
+                target = os.path.join(root, os.path.normpath(m.linkname))
+            else:
+                target = None
+            if target is not None and not _is_below(os.path.realpath(target), root):
+                raise exceptions.BuildCacheError("{0} links to {1}, which is outside the archive"
+                                                 .format(m.name, m.linkname))
+            tar.extract(m, dest_dir)
+    finally:
+        tar.close()
+
+def _check_member(info):
+    """Raise BuildCacheError if the TarInfo info does not belong in a cache entry
+    
+    Entries only contain regular files, directories and links, with relative 
+    paths and link targets that stay inside the archive. Only the names are
+    checked, _extract() also checks where they lead on disk.
+    """
+    path = os.path.normpath(info.name)
+    if _leaves_archive(path):
+        raise exceptions.BuildCacheError("{0} is outside the archive".format(info.name))
+    if info.isdev():
+        raise exceptions.BuildCacheError("{0} is a device or fifo".format(info.name))
+    
+    if info.issym():
+        target = os.path.join(os.path.dirname(path), info.linkname)
+    elif info.islnk():
+        target = info.linkname
+    else:
+        return
+    if os.path.isabs(info.linkname) or _leaves_archive(os.path.normpath(target)):
+        raise exceptions.BuildCacheError("{0} links to {1}, which is outside the archive"
+                                         .format(info.name, info.linkname))
+
+def _leaves_archive(path):
+    """Return True if the normalized relative path is absolute or goes above the archive root"""
+    return os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep)
+
+def _is_below(path, root):
+    path = os.path.normpath(path)
+    return path == root or path.startswith(root + os.sep)
+
+def _replace(src, dest):
+    """Rename src to dest, replacing dest if it exists"""
+    if sys.platform == "win32" and os.path.exists(dest):
+        #os.rename() does not replace files on Windows
+        os.remove(dest)
+    os.rename(src, dest)
@@ -34,23 +34,21 @@ def cmake(context, options={}, build_dir=""):
     options -- dictionary of CMake cache variables
     build_dir -- the directory used for the build (defaults to ./cmake_build)
     """
+    src_dir = system.getcwd()
     if not build_dir:
         build_dir = "cmake_build"
+    build_dir = os.path.join(src_dir, build_dir)
     
     if not os.path.exists(build_dir):
         os.mkdir(build_dir)
-        
-    os.chdir(build_dir)
     
     args = ["-D", "CMAKE_INSTALL_PREFIX=" + context.install_dir]
     for i in options.iteritems():
         args.extend(["-D", "=".join(i)])
     args.extend(["-G", cmake_generator(context.toolchain, context.arch)])
-    args.append(os.path.relpath(".", build_dir))
-    
-    system.run_cmd("cmake", args)
+    args.append(os.path.relpath(src_dir, build_dir))
     
-    os.chdir("..")
+    system.run_cmd("cmake", args, cwd=build_dir)
 
 def vc_version(toolchain):
     """Return the Visual C++ version from the toolchain string as an int"""
@@ -114,6 +112,11 @@ def vcbuild(context, filepath, config, platform=None, use_env=False, extra=None,
                        ignore_errors=ignore_errors)
     
 def vcproj_upgrade(vcproj_file):
+    """Convert a vc9 project to a .vcxproj unless that exists already, return its path
+    
+    A relative vcproj_file is relative to the current directory (see system.getcwd())
+    """
+    vcproj_file = os.path.join(system.getcwd(), vcproj_file)
     new_name = os.path.splitext(vcproj_file)[0] + ".vcxproj"
     
     if not os.path.exists(new_name):
@@ -123,7 +126,7 @@ def vcproj_upgrade(vcproj_file):
 
 def distutils(context, debug=False):
     if context.os_name == "win":
-        tmp_site_packages = context.install_dir + "\\Lib\site-packages"
+        tmp_site_packages = os.path.join(system.getcwd(), context.install_dir, "Lib", "site-packages")
         makedirs(tmp_site_packages, exist_ok=True)
         context.env["PYTHONPATH"] = tmp_site_packages
         context.env["INCLUDE"] += context.bundle_path + "\\include\python2.7;"
@@ -1,12 +1,43 @@
 import os
+import stat
+import time
+import itertools
 import shutil
 import sqlite3
 import logging
 
-from fileset import Categories
+from fileset import Categories, category_name
 import fileutils
 import exceptions
+import trash
+from manifest import Manifest, SCHEMA_VERSION
    
+#directory in the bundle root where identical files are stored once, see LibBundle.create()
+_objects_dir = ".objects"
+
+#files in the bundle root that belong to the bundle itself
+_reserved_names = frozenset(["MANIFEST.db", "MANIFEST.db-wal", "MANIFEST.db-shm", 
+                             "MANIFEST.db-journal", _objects_dir])
+
+def _split(path):
+    """Split a bundle relative path into (directory, name) as stored in the manifest
+    
+    directory ends with a separator, or is empty for files in the bundle root.
+    """
+    head, tail = os.path.split(path)
+    if head:
+        head += os.sep
+    return head, tail
+
+def _parents(path):
+    """Return the directories that contain the bundle relative path, innermost first"""
+    parents = []
+    path = os.path.dirname(path)
+    while path:
+        parents.append(path)
+        path = os.path.dirname(path)
+    return parents
+
 class Package:
     def __init__(self, name, version, deps, files_rel=[], files_dbg=[], files_dev=[]):
         self.name = name
@@ -23,8 +54,10 @@ class LibBundle:
         self.platform = None
         self.toolchain = None
         self.arch = None
+        self.objects = False
 
         self._manifest_path = None
+        self._manifest = None
     
     def load(self, path):
         if not path:
@@ -35,19 +68,23 @@ class LibBundle:
         
         self._verify()
         
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
-        r = cursor.execute("SELECT platform, toolchain, arch FROM info").fetchone()
+        r = self._manifest.fetchone("SELECT platform, toolchain, arch, objects FROM info")
         
-        self.patform = r[0]
+        self.platform = r[0]
         self.toolchain = r[1]
         self.arch = r[2]
+        self.objects = bool(r[3])
         self.is_setup = True
-        
-        connection.close()
             
-            
-    def create(self, path, platform, toolchain, arch):
+    def create(self, path, platform, toolchain, arch, objects=False):
+        """Create a new, empty bundle at path
+        
+        If objects is True, files with identical contents are only stored once,
+        in the .objects directory of the bundle, named after their SHA-256 
+        digest. Installed files are hard links to these objects, and an object
+        is deleted when no file in the manifest has its digest anymore. 
+        Modifying a file in place modifies every file linked to the same object.
+        """
         self.path = path
         
         if os.path.exists(self.path):
@@ -56,199 +93,709 @@ class LibBundle:
         self.platform = platform
         self.toolchain = toolchain
         self.arch = arch
+        self.objects = bool(objects)
         self._manifest_path = os.path.join(self.path, "MANIFEST.db")
         
         os.mkdir(self.path)
         
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
-
-        cursor.execute("CREATE TABLE installed"
-                       "(id INTEGER PRIMARY KEY AUTOINCREMENT,"
-                       "name TEXT UNIQUE, version TEXT)")
-        cursor.execute("CREATE TABLE files (id INT, name TEXT, category TEXT)")
-        cursor.execute("CREATE TABLE dep_graph (name TEXT, deps TEXT)")
-
-        cursor.execute("CREATE TABLE info (platform TEXT, toolchain TEXT, arch TEXT)")
-        cursor.execute("INSERT INTO info VALUES (?,?,?)", (platform, toolchain, arch))
-
-        connection.commit()
-        connection.close()
+        try:
+            self._open_manifest()
+            with self._manifest.transaction() as m:
+                m.create()
+                m.execute("INSERT INTO info (platform, toolchain, arch, objects) VALUES (?,?,?,?)",
+                          (platform, toolchain, arch, int(self.objects)))
+        except:
+            #do not leave a half created bundle behind, it would block creating it again
+            self.close()
+            fileutils.remove(self.path)
+            raise
         
         self.is_setup = True
     
+    def close(self):
+        """Close the manifest session"""
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+        self.is_setup = False
+    
+    def transaction(self):
+        """Return a context manager that groups manifest changes into one transaction
+        
+        Calls to install() and uninstall() inside the with block join the 
+        transaction instead of committing on their own. uninstall() deletes 
+        the package's files only after the transaction commits.
+        """
+        return self._manifest.transaction()
+    
     def is_installed(self, package_name):
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
-
-        row = cursor.execute("SELECT * FROM installed WHERE name = ?",
-                             (package_name,)).fetchone()
-        connection.commit()
-        connection.close()
-
-        return row != None
+        return self._package_id(package_name) is not None
+        
+    def fingerprint(self, package_name):
+        """Return the build fingerprint package_name was installed with, or None if unknown"""
+        row = self._manifest.fetchone("SELECT fingerprint FROM installed WHERE name = ?",
+                                      (package_name,))
+        if row is None:
+            return None
+        return row[0]
+    
+    def install(self, name, version, deps, fileset, force=False, mode="copy", checksum=False,
+                fingerprint=None):
+        """Install the files described by fileset as package name
         
-    def install(self, name, version, deps, fileset, force=False):
+        mode is how files get into the bundle, one of fileutils.INSTALL_MODES.
+        fingerprint identifies the build the files come from, see fingerprint().
+        
+        Reinstalling a package (force is True) only copies files that changed,
+        and deletes the files the package no longer installs. A file has 
+        changed if its size or modification time differ from the installed 
+        copy, or, if checksum is True, if its contents differ.
+        """
         if not self.is_setup:
             raise exceptions.BundleError("Instance of LibBundle not associated with any bundle on disk")
-        
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
-            
-        if force and self.is_installed(name):
-            #first remove entries from the database to avoid duplication
-            query = "SELECT id FROM installed WHERE name = ?"
-            lib_id = cursor.execute(query, (name,)).fetchone()[0]
-
-            cursor.execute("DELETE FROM files WHERE id = ?", (lib_id,))
-            cursor.execute("DELETE FROM installed WHERE id = ?", (lib_id,))
-            cursor.execute("DELETE FROM dep_graph WHERE name = ?", (name,))
-            
-        if force or not self.is_installed(name):
-            files = dict([(c, []) for c in Categories])
-            
-            for category in Categories:
-                for copy, exclude, dest in fileset.iter_items(category):
-                    files[category].extend(self._copy_into_bundle(copy, dest, exclude))
+        if mode not in fileutils.INSTALL_MODES:
+            raise exceptions.BundleError("Unknown install mode '{0}' (needs to be one of "
+                                         "[{1}])".format(mode, ", ".join(fileutils.INSTALL_MODES)))
+        
+        lib_id = self._package_id(name)
+        
+        if force or lib_id is None:
+            plan = fileset.resolve()
+            unchanged = {}
+            obsolete = []
+            #digests of the files that are replaced
+            released = []
+            if lib_id is not None:
+                installed = self._installed_stats(lib_id)
+                unchanged = self._unchanged_files(plan, installed, checksum)
+                obsolete = self._obsolete_paths(plan, installed)
+                released.extend(s[2] for s in installed.itervalues())
                 
-            query = "INSERT INTO installed (name, version) VALUES (?,?)"
-            cursor.execute(query, (name, version))
+                #the old files are deleted once the new manifest entries are committed,
+                #except those in a directory that is replaced by a file
+                file_dests = set(f[1] for f in plan.files)
+                blocking = set(p for p in obsolete if any(d in file_dests for d in _parents(p)))
+                if blocking:
+                    self._remove_paths(sorted(blocking))
+                    obsolete = [p for p in obsolete if p not in blocking]
             
-            query = "SELECT id FROM installed WHERE name = ?"
-            lib_id = cursor.execute(query, (name,)).fetchone()[0]
+            files, lstats = self._copy_into_bundle(plan, mode, unchanged)
             
-            query = "INSERT INTO files VALUES (?,?,?)"
+            entries = [e for c in Categories for e in files[c]]
+            stats = self._file_stats(entries, lstats, unchanged)
+            if self.objects:
+                self._link_objects(lstats, stats)
             
-            for category in Categories:
-                for filename in files[category]:
-                    cursor.execute(query, (lib_id, filename, category))
-
-            for dep_name in deps:
-                cursor.execute("INSERT INTO dep_graph VALUES (?,?)", (name, dep_name))
+            with self._manifest.transaction() as m:
+                if lib_id is not None:
+                    #first remove entries from the database to avoid duplication
+                    self._delete_entries(lib_id, name)
                 
-        connection.commit()
-        connection.close()
-        
+                query = "INSERT INTO installed (name, version, fingerprint) VALUES (?,?,?)"
+                lib_id = m.execute(query, (name, version, fingerprint)).lastrowid
+                
+                dir_ids = m.intern_dirs(e[0] for e in entries)
+                released.extend(self._take_ownership(name, lib_id, 
+                                                     ((dir_ids[prefix], basename) 
+                                                      for prefix, basename in entries)))
+                
+                m.executemany("INSERT INTO files VALUES (?,?,?,?,?,?,?)",
+                              ((lib_id, dir_ids[prefix], basename, category) + stats[(prefix, basename)]
+                               for category in Categories for prefix, basename in files[category]))
+                m.executemany("INSERT INTO dep_graph VALUES (?,?)",
+                              ((name, dep_name) for dep_name in deps))
+        
+                m.on_commit(self._remove_paths, obsolete)
+                m.on_commit(self._release_objects, released)
+    
     def uninstall(self, package_name):
-        if not self.is_installed(package_name):
+        lib_id = self._package_id(package_name)
+        if lib_id is None:
             raise exceptions.BundleError(package_name + " is not installed")
         
         files_delete = self.list_files(package_name)
+        digests = [r[0] for r in self._manifest.execute("SELECT digest FROM files WHERE id = ?", 
+                                                        (lib_id,))]
+        
+        with self._manifest.transaction() as m:
+            self._delete_entries(lib_id, package_name)
+            m.execute("DELETE FROM dirs WHERE id NOT IN (SELECT dir FROM files)")
+            #inside an enclosing transaction, the files must stay until it commits,
+            #or a rollback would leave the manifest listing files that are gone
+            m.on_commit(self._remove_paths, files_delete, warn_missing=True)
+            m.on_commit(self._release_objects, digests)
+    
+    def owners(self, path):
+        """Return the names of the packages that installed path
         
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
-        
-        query = "SELECT id FROM installed WHERE name = ?"
-        lib_id = cursor.execute(query, (package_name,)).fetchone()[0]
-
-        cursor.execute("DELETE FROM files WHERE id = ?", (lib_id,))
-        cursor.execute("DELETE FROM installed WHERE id = ?", (lib_id,))
-        cursor.execute("DELETE FROM dep_graph WHERE name = ?", (package_name,))
+        path is relative to the bundle. Packages that own a directory 
+        containing path are included as well.
+        """
+        query = ("SELECT installed.name FROM files "
+                 "JOIN dirs ON files.dir = dirs.id JOIN installed ON files.id = installed.id "
+                 "WHERE dirs.path = ? AND files.name = ?")
+        
+        result = []
+        path = os.path.normpath(path)
+        while path and path != os.curdir:
+            for row in self._manifest.execute(query, _split(path)):
+                if row[0] not in result:
+                    result.append(row[0])
+            path = os.path.dirname(path)
         
-        connection.commit()
-        connection.close()
-                
-        for name in files_delete:
-            if os.path.exists(os.path.join(self.path, name)):
-                fileutils.remove(os.path.join(self.path, name))
-            else:
-                logging.getLogger().warning("'{0}' does not exist".format(os.path.join(self.path, name)))
+        return result
     
     def deps(self, package_name):
         if not self.is_installed(package_name):
             raise exceptions.BundleError(package_name + " is not installed")
-            
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
         
         query = "SELECT deps FROM dep_graph WHERE name = ?"
-        result = [row[0] for row in cursor.execute(query, (package_name,))]
+        return [row[0] for row in self._manifest.execute(query, (package_name,))]
+    
+    def reverse_deps(self, package_name, transitive=True):
+        """Return the names of installed packages that depend on package_name
         
-        connection.close()
+        If transitive is True, packages that depend on it indirectly are 
+        included too. The result is ordered so that each package comes before
+        the packages it depends on, which is the order to uninstall them in.
+        """
+        if not transitive:
+            query = "SELECT name FROM dep_graph WHERE deps = ? ORDER BY name"
+            return [row[0] for row in self._manifest.execute(query, (package_name,))]
         
-        return result
+        return self._walk_dep_graph([package_name], "deps", "name")[package_name]
     
-    def list_installed(self):
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
+    def dependency_closure(self, package_name):
+        """Return the names of all packages that package_name depends on, directly or not
         
-        result = [(r[0], r[1]) for r in cursor.execute("SELECT name, version FROM installed")]
-        
-        connection.close()
+        The result is ordered so that each package comes after the packages it
+        depends on, which is the order to build them in.
+        """
+        if not self.is_installed(package_name):
+            raise exceptions.BundleError(package_name + " is not installed")
         
-        return result
+        return self._walk_dep_graph([package_name], "name", "deps")[package_name]
+    
+    def list_installed(self):
+        return [(r[0], r[1]) for r in self._manifest.execute("SELECT name, version FROM installed")]
         
     def list_files(self, package_name, category_name=None):
-        if not self.is_installed(package_name):
+        lib_id = self._package_id(package_name)
+        if lib_id is None:
             raise exceptions.BundleError(package_name + " is not installed")
-            
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
-        
-        query = "SELECT id FROM installed WHERE name = ?"
-        lib_id = cursor.execute(query, (package_name,)).fetchone()[0]
         
         if category_name:
             category = getattr(Categories, category_name)
-            query = "SELECT name FROM files WHERE id = ? AND category = ?"
-            files = [r[0] for r in cursor.execute(query, (lib_id, category))]
+            query = "SELECT name FROM file_paths WHERE id = ? AND category = ?"
+            files = [r[0] for r in self._manifest.execute(query, (lib_id, category))]
         else:
-            query = "SELECT name FROM files WHERE id = ?"
-            files = [r[0] for r in cursor.execute(query, (lib_id,))]
-        
-        connection.close()
+            query = "SELECT name FROM file_paths WHERE id = ?"
+            files = [r[0] for r in self._manifest.execute(query, (lib_id,))]
         
         return files
     
+    def iter_info(self, package_names=None, closures=False):
+        """Return a generator that yields a dict of information for each package
+        
+        The dict has the keys name, version, deps, files and size. files and 
+        size map category names to the number of files and their total size in
+        bytes. If package_names is None, all installed packages are included.
+        
+        If closures is True, the dict also has the keys all_deps and required_by,
+        as returned by dependency_closure() and reverse_deps(). They are looked
+        up for all the packages at once rather than one package at a time.
+        
+        Everything else comes from one query, and rows are read from the cursor 
+        as the generator is consumed.
+        """
+        if closures:
+            names = package_names
+            if names is None:
+                names = [r[0] for r in self.list_installed()]
+            all_deps = self._walk_dep_graph(names, "name", "deps")
+            required_by = self._walk_dep_graph(names, "deps", "name")
+        
+        query = ("SELECT installed.name, installed.version, deps.list, "
+                 "files.category, COUNT(files.rowid), TOTAL(files.size) "
+                 "FROM installed {0}"
+                 "LEFT JOIN (SELECT name, group_concat(deps, ' ') AS list "
+                 "           FROM dep_graph GROUP BY name) AS deps "
+                 "ON deps.name = installed.name "
+                 "LEFT JOIN files ON files.id = installed.id "
+                 "GROUP BY installed.id, files.category "
+                 "ORDER BY installed.name")
+        query = query.format(self._select_packages(package_names))
+        
+        rows = self._manifest.execute(query)
+        for name, group in itertools.groupby(rows, lambda r: r[0]):
+            info = None
+            for row in group:
+                if info is None:
+                    info = {"name":row[0], "version":row[1], "files":{}, "size":{},
+                            "deps":sorted(row[2].split()) if row[2] else []}
+                    if closures:
+                        info["all_deps"] = all_deps[name]
+                        info["required_by"] = required_by[name]
+                if row[3] is not None:
+                    category = category_name(int(row[3]))
+                    info["files"][category] = row[4]
+                    info["size"][category] = int(row[5])
+            yield info
+    
+    def iter_files(self, package_names=None, category=None):
+        """Return a generator that yields (package name, category name, path, size)
+        
+        Files are read from the cursor as the generator is consumed.
+        """
+        query = ("SELECT installed.name, file_paths.category, file_paths.name, file_paths.size "
+                 "FROM installed {0}JOIN file_paths ON file_paths.id = installed.id")
+        query = query.format(self._select_packages(package_names))
+        params = ()
+        if category:
+            query += " WHERE file_paths.category = ?"
+            params = (getattr(Categories, category),)
+        
+        for row in self._manifest.execute(query, params):
+            yield row[0], category_name(int(row[1])), row[2], row[3]
+    
     def list_missing_files(self):
-        pass
+        """Return a list of (package name, path) for tracked paths that do not exist"""
+        return self.check_files()[0]
 
     def list_untracked_files(self):
-        pass
+        """Return a list of files in the bundle that do not belong to any package"""
+        return self.check_files()[1]
+    
+    def check_files(self):
+        """Compare the bundle directory with the manifest
+        
+        Return a tuple (missing, untracked) as described in list_missing_files() 
+        and list_untracked_files(). The bundle is walked once, and each entry is
+        looked up in a set of all tracked paths loaded with a single query.
+        """
+        query = ("SELECT file_paths.name, installed.name "
+                 "FROM file_paths JOIN installed ON file_paths.id = installed.id")
+        remaining = dict(self._manifest.execute(query))
+        tracked = frozenset(remaining)
+        
+        untracked = []
+        #directories that are tracked themselves or are inside a tracked directory
+        owned_dirs = set()
+        
+        #symlinks to directories are tracked like files
+        for dirpath, dirs, files in fileutils.walk(self.path, follow_links=False):
+            rel_dir = os.path.relpath(dirpath, self.path)
+            if rel_dir == os.curdir:
+                rel_dir = ""
+                dirs[:] = [n for n in dirs if n not in _reserved_names]
+                files = [n for n in files if n not in _reserved_names]
+            
+            owned = rel_dir in owned_dirs
+            for n in dirs:
+                path = os.path.join(rel_dir, n)
+                remaining.pop(path, None)
+                if owned or path in tracked:
+                    owned_dirs.add(path)
+            for n in files:
+                path = os.path.join(rel_dir, n)
+                remaining.pop(path, None)
+                if not owned and path not in tracked:
+                    untracked.append(path)
+        
+        missing = sorted((package, path) for path, package in remaining.iteritems())
+        return missing, sorted(untracked)
+        
+    def verify(self, package_name=None, full=False):
+        """Check that installed files have not changed since they were installed
+        
+        Return a sorted list of (package name, path, problem) where problem is
+        "missing" or "modified". A file is only hashed again if its mtime 
+        changed (and its size did not), or if full is True.
+        """
+        query = ("SELECT installed.name, file_id, file_paths.name, size, mtime, digest "
+                 "FROM file_paths JOIN installed ON file_paths.id = installed.id")
+        params = ()
+        if package_name is not None:
+            if not self.is_installed(package_name):
+                raise exceptions.BundleError(package_name + " is not installed")
+            query += " WHERE installed.name = ?"
+            params = (package_name,)
+        
+        problems = []
+        rehash = {}
+        for package, rowid, name, size, mtime, digest in self._manifest.execute(query, params):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                problems.append((package, name, "missing"))
+                continue
+            
+            if digest is None:
+                #directories, and files installed before digests were recorded
+                continue
+            if st.st_size != size:
+                problems.append((package, name, "modified"))
+            elif full or st.st_mtime != mtime:
+                rehash[path] = (package, rowid, name, digest, st.st_mtime != mtime, st.st_mtime)
+        
+        touched = []
+        for path, digest in fileutils.digest_files(rehash.keys()):
+            package, rowid, name, old_digest, mtime_changed, mtime = rehash[path]
+            if digest != old_digest:
+                problems.append((package, name, "modified"))
+            elif mtime_changed:
+                touched.append((mtime, rowid))
+        
+        if touched:
+            #content is unchanged, remember the new mtime so the file is not hashed next time
+            with self._manifest.transaction() as m:
+                m.executemany("UPDATE files SET mtime = ? WHERE rowid = ?", touched)
+        
+        return sorted(problems)
         
     def delete_files(self, package_name, files):
-        pass
-
-    def _copy_into_bundle(self, patterns, dest_dir, exclude_patterns=[]):
-        """copy files and directories described by patterns to dest_dir
+        """Remove files from a package, deleting them from disk if they exist"""
+        lib_id = self._package_id(package_name)
+        if lib_id is None:
+            raise exceptions.BundleError(package_name + " is not installed")
         
-        dest_dir is assumed to be relative to the bundle path
-        """
-        dest_dir = os.path.normpath(dest_dir).lstrip("/").lstrip("\\")
-        abs_dest_dir = os.path.join(self.path, dest_dir)
-
-        copied = set()
-        
-        for pattern in patterns:
-            for path in fileutils.glob(pattern):
-                if not fileutils.match_list(path, exclude_patterns):
-                    if not pattern.count("**"):
-                        basename = os.path.basename(path)
-                        fileutils.copy(path, os.path.join(abs_dest_dir, basename), parents=True, 
-                                       replace=True, ignore=fileutils.copy_ignore(exclude_patterns))
-                        copied.add(os.path.join(dest_dir, basename))
-                    else:
-                        #strip the fixed portion of the path
-                        #we only want to keep the directory structure after the glob expression
-                        pattern_segments = fileutils.separate_path(pattern)
-                        path_segments = fileutils.separate_path(path)
-                        new_root_i = pattern_segments.index("**")
-                        dest = os.path.join(abs_dest_dir, *path_segments[new_root_i:])
-
-                        fileutils.copy(path, dest, parents=True, replace=True, 
-                                       ignore=fileutils.copy_ignore(exclude_patterns))
+        names = frozenset(files)
+        query = "SELECT name, digest FROM file_paths WHERE id = ?"
+        digests = [r[1] for r in self._manifest.execute(query, (lib_id,)) if r[0] in names]
+        
+        with self._manifest.transaction() as m:
+            query = ("DELETE FROM files WHERE id = ? AND name = ? AND "
+                     "dir = (SELECT id FROM dirs WHERE path = ?)")
+            m.executemany(query, ((lib_id,) + tuple(reversed(_split(name))) for name in files))
+        
+        self._remove_paths(files)
+        self._release_objects(digests)
 
-                        #to save memory, only the first level after root is added to 'copied'
-                        copied.add(os.path.join(dest_dir, *path_segments[new_root_i:new_root_i+1]))
+    def _copy_into_bundle(self, plan, mode="copy", unchanged={}):
+        """Copy the files of a CopyPlan (see FileSet.resolve()) into the bundle
+        
+        Return a tuple (files, stats). files is a dict that maps each category
+        to a list with an entry for every file in the plan. Entries are
+        (directory, name) tuples as returned by _split(), where each distinct
+        directory string is only stored once. stats maps the absolute path of
+        each copy to its lstat() result.
+        
+        Files whose entries are in unchanged are already installed and are not
+        copied again. Directories are created first, and then files are copied
+        concurrently.
+        """
+        for d in plan.dirs:
+            fileutils.makedirs(os.path.join(self.path, d), exist_ok=True)
+        
+        files = dict([(c, []) for c in Categories])
+        prefixes = {}
+        pairs = []
+        for src, dest, category in plan.files:
+            prefix, name = _split(dest)
+            if prefix not in prefixes:
+                fileutils.makedirs(os.path.join(self.path, prefix), exist_ok=True)
+            entry = (prefixes.setdefault(prefix, prefix), name)
+            files[category].append(entry)
+            if entry not in unchanged:
+                pairs.append((src, os.path.join(self.path, dest)))
+        
+        #all directories exist, so the files can be copied in any order
+        stats = {}
+        start = time.time()
+        for src, dest, st in fileutils.copy_files(pairs, mode=mode):
+            stats[dest] = st
+        elapsed = max(time.time() - start, 1e-6)
+        
+        size = sum(st.st_size for st in stats.itervalues()) / (1024.0 * 1024.0)
+        logging.getLogger().info("Copied {0} files ({1:.1f} MB) in {2:.2f}s, "
+                                 "{3:.0f} files/s, {4:.1f} MB/s".format(len(stats), size, elapsed,
+                                                                        len(stats) / elapsed, size / elapsed))
+        return files, stats
 
-        return copied
+    def _open_manifest(self):
+        if self._manifest is not None:
+            self._manifest.close()
+        self._manifest = Manifest(self._manifest_path)
+    
+    def _file_stats(self, entries, lstats={}, known={}):
+        """Return a dict that maps each (directory, name) entry to (size, mtime, digest)
+        
+        lstats can map absolute paths to lstat() results that are already known,
+        and known can map entries to their (size, mtime, digest).
+        """
+        stats = {}
+        hash_paths = {}
+        for entry in entries:
+            if entry in known:
+                stats[entry] = known[entry]
+                continue
+            path = os.path.join(self.path, entry[0] + entry[1])
+            st = lstats.get(path)
+            if st is None:
+                st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                stats[entry] = (None, None, None)
+            else:
+                stats[entry] = (st.st_size, st.st_mtime, None)
+                hash_paths[path] = entry
+        
+        for path, digest in fileutils.digest_files(hash_paths.keys()):
+            entry = hash_paths[path]
+            stats[entry] = stats[entry][:2] + (digest,)
+        
+        return stats
+    
+    def _link_objects(self, lstats, stats):
+        """Replace copied files by hard links into the object store
+        
+        lstats maps the absolute paths of the files that were copied to their
+        lstat() results, and stats is the dict returned by _file_stats() for
+        them, which is updated to match the linked files. A file whose 
+        digest is not in the store yet becomes the object itself. Files whose
+        permissions differ from the object's are left alone.
+        """
+        if not hasattr(os, "link"):
+            return
+        objects_path = os.path.join(self.path, _objects_dir)
+        fileutils.makedirs(objects_path, exist_ok=True)
+        
+        for entry, (size, mtime, digest) in stats.items():
+            path = os.path.join(self.path, entry[0] + entry[1])
+            st = lstats.get(path)
+            if st is None or not stat.S_ISREG(st.st_mode):
+                continue
+            
+            object_path = os.path.join(objects_path, digest)
+            try:
+                try:
+                    object_st = os.lstat(object_path)
+                except OSError:
+                    os.link(path, object_path)
+                    continue
+                if (object_st.st_ino, object_st.st_dev) == (st.st_ino, st.st_dev):
+                    continue
+                if stat.S_IMODE(object_st.st_mode) != stat.S_IMODE(st.st_mode):
+                    continue
+                
+                #link next to the file and rename it over the file, so it is never missing
+                tmp_path = path + ".clbundler-tmp"
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                os.link(object_path, tmp_path)
+                if os.name == "nt":
+                    os.remove(path)
+                os.rename(tmp_path, path)
+            except OSError as e:
+                #e.g. the file system does not support hard links
+                logging.getLogger().debug("Not linking {0} into the object store: {1}".format(path, e))
+                continue
+            stats[entry] = (size, object_st.st_mtime, digest)
+    
+    def _release_objects(self, digests):
+        """Delete objects from the store that no file in the manifest has the digest of"""
+        if not self.objects:
+            return
+        query = "SELECT 1 FROM files WHERE digest = ? LIMIT 1"
+        for digest in set(digests):
+            if digest and self._manifest.fetchone(query, (digest,)) is None:
+                path = os.path.join(self.path, _objects_dir, digest)
+                if os.path.lexists(path):
+                    os.remove(path)
+    
+    def _installed_stats(self, lib_id):
+        """Return a dict that maps the (directory, name) entry of each file of lib_id 
+        to its (size, mtime, digest) in the manifest
+        """
+        query = ("SELECT dirs.path, files.name, size, mtime, digest FROM files "
+                 "JOIN dirs ON files.dir = dirs.id WHERE files.id = ?")
+        return dict(((r[0], r[1]), r[2:]) for r in self._manifest.execute(query, (lib_id,)))
+    
+    def _unchanged_files(self, plan, installed, checksum=False):
+        """Return the subset of installed (see _installed_stats()) that does not
+        need to be copied again to install plan
+        
+        A file is unchanged if the copy in the bundle has not been modified since
+        it was installed, and its source has the same size and modification 
+        time, or the same digest if checksum is True. Symbolic links are 
+        unchanged if they have the same target.
+        """
+        unchanged = {}
+        candidates = {}
+        for src, dest, category in plan.files:
+            entry = _split(dest)
+            if entry not in installed or installed[entry][0] is None:
+                continue
+            size, mtime, digest = installed[entry]
+            try:
+                src_st = os.lstat(src)
+                dest_st = os.lstat(os.path.join(self.path, dest))
+            except OSError:
+                continue
+            if dest_st.st_size != size or dest_st.st_mtime != mtime:
+                continue
+            
+            if stat.S_ISLNK(src_st.st_mode) or stat.S_ISLNK(dest_st.st_mode):
+                if (stat.S_ISLNK(src_st.st_mode) and stat.S_ISLNK(dest_st.st_mode) and 
+                    os.readlink(src) == os.readlink(os.path.join(self.path, dest))):
+                    unchanged[entry] = installed[entry]
+            elif checksum:
+                if src_st.st_size == size:
+                    candidates[src] = entry
+            elif src_st.st_size == size and abs(src_st.st_mtime - mtime) < 0.001:
+                unchanged[entry] = installed[entry]
+        
+        for src, digest in fileutils.digest_files(candidates.keys()):
+            entry = candidates[src]
+            if digest == installed[entry][2]:
+                unchanged[entry] = installed[entry]
+        
+        return unchanged
+    
+    def _obsolete_paths(self, plan, installed):
+        """Return the paths in installed (see _installed_stats()) that plan does not install
+        
+        Directories that plan installs files into are never included, even if
+        they are tracked as a whole by a bundle from before every file was 
+        recorded.
+        """
+        needed = set()
+        for path in itertools.chain(plan.dirs, (f[1] for f in plan.files)):
+            while path and path not in needed:
+                needed.add(path)
+                path = os.path.dirname(path)
+        
+        paths = (prefix + name for prefix, name in installed)
+        return sorted(p for p in paths if p not in needed)
+    
+    def _remove_paths(self, names, warn_missing=False):
+        """Delete bundle relative paths, and then the directories they leave empty
+        
+        Files are unlinked right away. Directories (tracked by bundles from 
+        before every file was recorded) are moved to the trash and deleted in
+        the background.
+        """
+        for name in names:
+            path = os.path.join(self.path, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                trash.discard(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            elif warn_missing:
+                logging.getLogger().warning("'{0}' does not exist".format(path))
+        
+        self._remove_empty_dirs(os.path.dirname(name) for name in names)
+    
+    def _remove_empty_dirs(self, dirs):
+        """Remove directories (relative to the bundle) and their ancestors if they are empty"""
+        candidates = set()
+        for d in dirs:
+            while d and d not in candidates:
+                candidates.add(d)
+                d = os.path.dirname(d)
+        
+        #deepest first, so that parents are empty by the time they are reached
+        for d in sorted(candidates, key=lambda d: d.count(os.sep), reverse=True):
+            try:
+                os.rmdir(os.path.join(self.path, d))
+            except OSError:
+                pass
+    
+    def _take_ownership(self, package_name, lib_id, entries):
+        """Remove (dir id, name) entries from packages other than lib_id, and
+        return the digests of the removed rows
+        
+        Files that were installed by another package have just been overwritten,
+        so they now belong to package_name. Each entry is looked up in the 
+        files(dir, name) index, so this is proportional to the size of the new 
+        package, not the bundle.
+        """
+        m = self._manifest
+        m.execute("CREATE TEMP TABLE IF NOT EXISTS new_files (dir INT, name TEXT)")
+        m.execute("DELETE FROM new_files")
+        m.executemany("INSERT INTO new_files VALUES (?,?)", entries)
+        
+        query = ("SELECT files.rowid, installed.name, dirs.path || files.name, files.digest "
+                 "FROM new_files JOIN files ON files.dir = new_files.dir AND files.name = new_files.name "
+                 "JOIN installed ON files.id = installed.id JOIN dirs ON files.dir = dirs.id "
+                 "WHERE files.id != ?")
+        conflicts = m.fetchall(query, (lib_id,))
+        m.execute("DELETE FROM new_files")
+        
+        if conflicts:
+            logger = logging.getLogger()
+            logger.warning("{0} overwrote {1} files installed by other packages:".format(
+                           package_name, len(conflicts)))
+            for rowid, owner, path, digest in sorted(conflicts, key=lambda c: c[2]):
+                logger.warning("  {0} ({1})".format(path, owner))
+            
+            m.executemany("DELETE FROM files WHERE rowid = ?", ((c[0],) for c in conflicts))
+        return [c[3] for c in conflicts]
+    
+    def _walk_dep_graph(self, package_names, from_column, to_column):
+        """Map each of package_names to the packages reachable from it in dep_graph, farthest first
+        
+        Edges are followed from from_column to to_column with one recursive query
+        for all the names. The depth is capped by the number of installed packages, 
+        so a cycle in the graph cannot make the query run forever.
+        """
+        m = self._manifest
+        m.execute("CREATE TEMP TABLE IF NOT EXISTS walk_start (name TEXT)")
+        m.execute("DELETE FROM walk_start")
+        m.executemany("INSERT INTO walk_start VALUES (?)", ((n,) for n in set(package_names)))
+        
+        query = ("WITH RECURSIVE reached(start, name, depth) AS ("
+                 "SELECT walk_start.name, dep_graph.{1}, 1 FROM walk_start "
+                 "JOIN dep_graph ON dep_graph.{0} = walk_start.name "
+                 "UNION "
+                 "SELECT reached.start, dep_graph.{1}, reached.depth + 1 FROM dep_graph "
+                 "JOIN reached ON dep_graph.{0} = reached.name "
+                 "WHERE reached.depth <= (SELECT COUNT(*) FROM installed)) "
+                 "SELECT start, name FROM reached WHERE name != start "
+                 "GROUP BY start, name "
+                 "ORDER BY start, MAX(depth) DESC, name").format(from_column, to_column)
+        
+        result = dict((n, []) for n in package_names)
+        for start, name in m.execute(query):
+            result[start].append(name)
+        return result
+    
+    def _select_packages(self, package_names):
+        """Return a join clause that limits a query on installed to package_names
+        
+        The names are put in a temporary table, so any number can be given.
+        Nothing is returned if package_names is None.
+        """
+        if package_names is None:
+            return ""
+        
+        for n in package_names:
+            if not self.is_installed(n):
+                raise exceptions.BundleError(n + " is not installed")
+        
+        m = self._manifest
+        m.execute("CREATE TEMP TABLE IF NOT EXISTS selected (name TEXT)")
+        m.execute("DELETE FROM selected")
+        m.executemany("INSERT INTO selected VALUES (?)", ((n,) for n in set(package_names)))
+        return "JOIN selected ON selected.name = installed.name "
+    
+    def _package_id(self, package_name):
+        row = self._manifest.fetchone("SELECT id FROM installed WHERE name = ?",
+                                      (package_name,))
+        if row is None:
+            return None
+        return row[0]
+    
+    def _delete_entries(self, lib_id, package_name):
+        self._manifest.execute("DELETE FROM files WHERE id = ?", (lib_id,))
+        self._manifest.execute("DELETE FROM installed WHERE id = ?", (lib_id,))
+        self._manifest.execute("DELETE FROM dep_graph WHERE name = ?", (package_name,))
 
     def _verify(self):
         if not os.path.exists(self._manifest_path):
             raise exceptions.BundleError("Not a valid bundle: missing database")
         
-        connection = sqlite3.connect(self._manifest_path)
-        cursor = connection.cursor()
+        self._open_manifest()
         
         tables = {"dep_graph":["name", "deps"],
                   "files":["id", "name", "category"],
@@ -257,9 +804,11 @@ class LibBundle:
         for table, columns in tables.iteritems():
             try:
                 for cn in columns:
-                    cursor.execute("SELECT {0} FROM {1}".format(cn, table))
+                    self._manifest.execute("SELECT {0} FROM {1}".format(cn, table))
             except sqlite3.OperationalError:
-                connection.close()
+                self.close()
                 raise exceptions.BundleError("Not a valid bundle: database layout is incorrect")
         
-        connection.close()
+        if self._manifest.schema_version() != SCHEMA_VERSION:
+            logging.getLogger().info("Upgrading bundle database...")
+            self._manifest.migrate()
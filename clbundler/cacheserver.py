@@ -0,0 +1,128 @@
+"""A minimal HTTP server for sharing a build cache
+
+Serves the cache entries in a directory with GET and stores the entries
+uploaded with PUT. Set remote in the [BuildCache] section of the configuration
+to its URL to use it, e.g. http://buildserver:8000/
+
+There is no authentication, only run it on a trusted network.
+"""
+import os
+import re
+import sys
+import errno
+import shutil
+import logging
+import optparse
+import tempfile
+import BaseHTTPServer
+import SocketServer
+
+#fingerprint followed by the extension of an archive or its metadata
+_entry_name = re.compile(r"^[0-9a-f]{64}\.(tar\.gz|json)$")
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self._send_file(False)
+    
+    def do_GET(self):
+        self._send_file(True)
+    
+    def do_PUT(self):
+        path = self._entry_path()
+        if path is None:
+            return
+        length = self.headers.getheader("Content-Length")
+        if length is None:
+            self.send_error(411)
+            return
+        
+        fd, tmp_path = tempfile.mkstemp(".tmp", os.path.basename(path), self.server.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                remaining = int(length)
+                while remaining > 0:
+                    data = self.rfile.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise IOError("connection closed after {0} of {1} bytes".format(
+                                      int(length) - remaining, length))
+                    f.write(data)
+                    remaining -= len(data)
+            if sys.platform == "win32" and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        #client_address instead of address_string(), which does a reverse DNS lookup
+        logging.getLogger().info("%s %s", self.client_address[0], format % args)
+    
+    def _send_file(self, send_body):
+        path = self._entry_path()
+        if path is None:
+            return
+        try:
+            f = open(path, "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.send_error(404)
+            return
+        
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if send_body:
+                shutil.copyfileobj(f, self.wfile)
+        finally:
+            f.close()
+    
+    def _entry_path(self):
+        """Return the path of the requested entry, or send an error and return None"""
+        name = self.path.split("?")[0].rsplit("/", 1)[-1]
+        if not _entry_name.match(name):
+            self.send_error(404)
+            return None
+        return os.path.join(self.server.directory, name)
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the cache entries in directory, one thread per request"""
+    daemon_threads = True
+    
+    def __init__(self, address, directory):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.directory = directory
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] DIRECTORY",
+                                   description=__doc__.split("\n")[0])
+    parser.add_option("-b", "--bind", dest="address", default="",
+                      help="Address to listen on [default: all interfaces]")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8000,
+                      help="Port to listen on [default: %default]")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("no directory specified")
+    
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if not os.path.isdir(args[0]):
+        os.makedirs(args[0])
+    
+    server = CacheServer((options.address, options.port), os.path.abspath(args[0]))
+    logging.getLogger().info("Serving {0} on port {1}".format(args[0], server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
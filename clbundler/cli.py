@@ -7,7 +7,7 @@ def on_new(parser, options, args):
         parser.error("too few arguments")
     if not (args[2] == "x86" or args[2] == "x64"):
         parser.error("Unknown architecture '{0}' (needs to be one of [x86, x64])".format(args[2]))
-    commands.cmd_new(args[0], args[1], args[2])
+    commands.cmd_new(args[0], args[1], args[2], options.objects)
 
 def on_use(parser, options, args):
     if not args:
@@ -17,6 +17,10 @@ def on_use(parser, options, args):
 def on_install(parser, options, args):
     if not args:
         parser.error("no formula specified")
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.jobs > 1 and options.interactive:
+        parser.error("--interactive cannot be used with --jobs")
     for n in args:
         commands.cmd_install(n, options)
 
@@ -30,7 +34,7 @@ def on_archive(parser, options, args):
     commands.cmd_archive(options.path)
 
 def on_info(parser, options, args):
-    commands.cmd_info()
+    commands.cmd_info(args, options.json)
     
 def on_formula_path(parser, options, args):
     if not args:
@@ -42,7 +46,21 @@ def on_list(parser, options, args):
     if not args:
         parser.error("no package name specified")
     else:
-        commands.cmd_list(args[0], options.category)
+        commands.cmd_list(args, options.category, options.json)
+
+def on_check(parser, options, args):
+    commands.cmd_check(options.fix)
+
+def on_verify(parser, options, args):
+    if len(args) > 1:
+        parser.error("too many arguments")
+    commands.cmd_verify(args[0] if args else None, options.full)
+
+def on_owns(parser, options, args):
+    if not args:
+        parser.error("no path specified")
+    for path in args:
+        commands.cmd_owns(path)
 
 def setup_parser(parser):
     parser.usage = "clbundler <command> [options]" 
@@ -55,6 +73,9 @@ def setup_parser(parser):
                             usage=usage.format("new","PATH TOOLCHAIN ARCH"), 
                             short_help="Sets up a new bundle",
                             detailed_help="Currently, only vc9 is the only supported TOOLCHAIN")
+    subcommand.add_option("--objects", dest="objects", action="store_true", default=False,
+                          help="Store files with identical contents only once, as hard links "
+                               "into the .objects directory of the bundle")
     parser.add_subcommand(subcommand)
     
     subcommand = Subcommand("use", callback=on_use,
@@ -67,12 +88,34 @@ def setup_parser(parser):
                             short_help="Install a library into a bundle")
     subcommand.add_option("-f", "--force", dest="force", action="store_true",
                           help="Install even if already installed")
+    subcommand.add_option("-u", "--update", dest="update", action="store_true",
+                          help="Rebuild FORMULA and its dependencies if their formulas, patches, "
+                               "sources or options changed since they were installed, or if "
+                               "one of their dependencies was rebuilt")
     subcommand.add_option("-i", "--interactive", dest="interactive", action="store_true",
                           help="Start a shell after downloading and patching the source")
     subcommand.add_option("--clean-src", dest="clean_src", action="store_true",
                           help="Use clean source tree")
     subcommand.add_option("--variant", dest="variant", action="store", choices=("release", "debug", "release+debug"),
                           help="Specify build variant {release, debug, release+debug}")
+    subcommand.add_option("--install-mode", dest="install_mode", action="store", 
+                          choices=("copy", "hardlink", "reflink", "move"),
+                          help="How files get into the bundle {copy, hardlink, reflink, move}. "
+                               "Modes other than copy fall back to copying when the file system "
+                               "does not support them. Default: install_mode in the Bundle "
+                               "section of the configuration, or copy")
+    subcommand.add_option("-c", "--checksum", dest="checksum", action="store_true",
+                          help="When reinstalling, compare files by contents instead of "
+                               "size and modification time")
+    subcommand.add_option("-n", "--dry-run", dest="dry_run", action="store_true",
+                          help="Build FORMULA and show which files would be installed, "
+                               "without installing them")
+    subcommand.add_option("--no-cache", dest="no_cache", action="store_true",
+                          help="Build from source even if the build cache has a build with "
+                               "the same formula, patches, options and dependencies")
+    subcommand.add_option("-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+                          help="Build up to JOBS formulas at the same time. A formula is "
+                               "built once all of its dependencies are installed")
     parser.add_subcommand(subcommand)
     
     subcommand = Subcommand("uninstall", callback=on_uninstall,
@@ -98,14 +141,45 @@ def setup_parser(parser):
     parser.add_subcommand(subcommand)
     
     subcommand = Subcommand("info", callback=on_info,
-                            usage=usage.format("info","[PACKAGE]"),
+                            usage=usage.format("info","[PACKAGE...]"),
                             short_help="Show information about installed packages",
                             detailed_help="If PACKAGE is not given, all installed packages will be shown")
+    subcommand.add_option("--json", dest="json", action="store_true",
+                          help="Print one JSON object per package, with version, "
+                               "dependencies, file counts and sizes")
     parser.add_subcommand(subcommand)
     
     subcommand = Subcommand("list", callback=on_list,
-                            usage=usage.format("list","PACKAGE"),
+                            usage=usage.format("list","PACKAGE..."),
                             short_help="List files that belong to PACKAGE")
+    subcommand.add_option("--json", dest="json", action="store_true",
+                          help="Print one JSON object per file, with package, category, path and size")
     subcommand.add_option("-c", "--category", dest="category", choices=("run", "run_dbg", "build"),
                           help="Only show files belonging to a specific category:\n{run, run_dbg, build}")
     parser.add_subcommand(subcommand)
+    
+    subcommand = Subcommand("check", callback=on_check,
+                            usage="check [options]",
+                            short_help="Check the bundle for missing and untracked files",
+                            detailed_help="Missing files are tracked by a package but do not exist. "
+                                          "Untracked files exist in the bundle but do not belong "
+                                          "to any package")
+    subcommand.add_option("--fix", dest="fix", action="store_true",
+                          help="Remove missing files from the manifest")
+    parser.add_subcommand(subcommand)
+    
+    subcommand = Subcommand("verify", callback=on_verify,
+                            usage=usage.format("verify","[PACKAGE]"),
+                            short_help="Check that installed files have not been modified",
+                            detailed_help="If PACKAGE is not given, all installed packages will "
+                                          "be checked. Only files with a changed modification "
+                                          "time are hashed again, unless --full is given")
+    subcommand.add_option("--full", dest="full", action="store_true",
+                          help="Hash every file")
+    parser.add_subcommand(subcommand)
+    
+    subcommand = Subcommand("owns", callback=on_owns,
+                            usage=usage.format("owns","PATH"),
+                            short_help="Show which package installed PATH",
+                            detailed_help="PATH is either absolute or relative to the bundle")
+    parser.add_subcommand(subcommand)
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import json
 import logging
 
 import config
@@ -16,13 +17,13 @@ def cmd_set(path):
     config.global_config().set("Bundle", "path", path)
     config.global_config().write()
 
-def cmd_new(path, toolchain, arch):
+def cmd_new(path, toolchain, arch, objects=False):
     fpath = path.format(p=config.os_name(), t=toolchain, a=arch)
     if fpath.split(os.sep)[0] == fpath:
         fpath = os.path.join(config.global_config().root_dir(), fpath)
 
     bundle = LibBundle()
-    bundle.create(fpath, config.os_name(), toolchain, arch)
+    bundle.create(fpath, config.os_name(), toolchain, arch, objects)
 
     cmd_set(fpath)
 
@@ -63,16 +64,18 @@ def cmd_archive(path=None):
     
     if config.os_name() == "win":
         try:
-            system.run_cmd("7z", ["a", "-r", 
+            system.run_cmd("7z", ["a", "-r", "-xr!.objects",
                            archive_path + ".7z", 
                            config.global_config().current_bundle()])
         except exceptions.CalledProcessError as e:
             if e.returncode != 1:
                 raise
     else:
+        #files in the object store are also in the bundle tree as hard links
         system.run_cmd("zip", ["-r", 
                                archive_path + ".zip", 
-                               config.global_config().current_bundle()])
+                               config.global_config().current_bundle(),
+                               "-x", "*/.objects/*"])
 
 def cmd_set_formula_path(path, append=False):
     if append:
@@ -85,10 +88,25 @@ def cmd_set_formula_path(path, append=False):
         
     config.global_config().write()
 
-def cmd_info():
+def cmd_info(package_names=None, as_json=False):
     bundle = LibBundle()
     bundle.load(config.global_config().current_bundle())
     
+    if as_json:
+        for info in bundle.iter_info(package_names or None):
+            print(json.dumps(info, sort_keys=True))
+        return
+    
+    if package_names:
+        for info in bundle.iter_info(package_names, closures=True):
+            print("{0} {1}".format(info["name"], info["version"]))
+            print("Depends on: " + ", ".join(info["all_deps"]))
+            print("Required by: " + ", ".join(info["required_by"]))
+            for category in sorted(info["files"]):
+                print("{0:<10}{1:>8} files {2:>12} bytes".format(category, info["files"][category], 
+                                                                 info["size"][category]))
+        return
+    
     print("Bundle: " + bundle.path)
     print("Toolchain: " + bundle.toolchain)
     print("Architecture: " + bundle.arch)
@@ -96,10 +114,59 @@ def cmd_info():
     for info in sorted(bundle.list_installed()):
         print("{0:<15}{1:<10}".format(info[0], info[1]))
 
-def cmd_list(package_name, category=None):
+def cmd_list(package_names, category=None, as_json=False):
+    bundle = LibBundle()
+    bundle.load(config.global_config().current_bundle())
+    
+    for package_name, category_name, path, size in bundle.iter_files(package_names, category):
+        if as_json:
+            print(json.dumps({"package":package_name, "category":category_name, 
+                              "path":path, "size":size}, sort_keys=True))
+        else:
+            print(path)
+
+def cmd_check(fix=False):
+    bundle = LibBundle()
+    bundle.load(config.global_config().current_bundle())
+    
+    missing, untracked = bundle.check_files()
+    
+    for package_name, path in missing:
+        print("missing: {0} ({1})".format(path, package_name))
+    for path in untracked:
+        print("untracked: " + path)
+    
+    if fix and missing:
+        packages = {}
+        for package_name, path in missing:
+            packages.setdefault(package_name, []).append(path)
+        for package_name, paths in packages.iteritems():
+            bundle.delete_files(package_name, paths)
+        print("Removed {0} missing files from the manifest".format(len(missing)))
+    
+    if not missing and not untracked:
+        print("No problems found")
+
+def cmd_verify(package_name=None, full=False):
+    bundle = LibBundle()
+    bundle.load(config.global_config().current_bundle())
+    
+    problems = bundle.verify(package_name, full)
+    for package_name, path, problem in problems:
+        print("{0}: {1} ({2})".format(problem, path, package_name))
+    
+    if not problems:
+        print("No problems found")
+
+def cmd_owns(path):
     bundle = LibBundle()
     bundle.load(config.global_config().current_bundle())
     
-    files = bundle.list_files(package_name, category)
-    for n in files:
-        print(n)
+    if os.path.isabs(path):
+        path = os.path.relpath(path, bundle.path)
+    
+    owners = bundle.owners(path)
+    if owners:
+        print("{0} is owned by {1}".format(path, ", ".join(owners)))
+    else:
+        print("No package owns " + path)
@@ -82,6 +82,34 @@ class Config(SafeConfigParser):
         if self.has_option("Bundle", "path"):
             return self.get("Bundle", "path")
         return None        
+    
+    def install_mode(self):
+        if self.has_option("Bundle", "install_mode"):
+            return self.get("Bundle", "install_mode")
+        return "copy"
+        
+    def build_cache_dir(self):
+        if self.has_option("Paths", "build_cache"):
+            return self.get("Paths", "build_cache")
+        return os.path.join(self.workspace_dir(), "build_cache")
+    
+    def build_cache_size(self):
+        """Return the maximum size of the build cache in bytes, 0 if it is disabled"""
+        max_size_mb = 10240
+        if self.has_option("BuildCache", "max_size"):
+            max_size_mb = self.getint("BuildCache", "max_size")
+        return max_size_mb * 1024 * 1024
+        
+    def build_cache_remote(self):
+        """Return the URL or path of the shared build cache, or None"""
+        if self.has_option("BuildCache", "remote"):
+            return self.get("BuildCache", "remote") or None
+        return None
+    
+    def build_cache_upload(self):
+        if self.has_option("BuildCache", "upload"):
+            return self.getboolean("BuildCache", "upload")
+        return True
         
 def os_name():
     p = platform.platform()
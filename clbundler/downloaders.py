@@ -66,7 +66,8 @@ class ArchiveSourceDownloader(AbstractSourceDownloader):
         
     def stage(self):
         if not os.path.exists(self.dest_dir):
-            tmp_dir = os.path.join(self.cache_dir, "tmp")
+            #one per package, other packages may be extracted at the same time
+            tmp_dir = os.path.join(self.cache_dir, "tmp_" + os.path.basename(self.dest_dir))
             if os.path.exists(tmp_dir):
                 shutil.rmtree(tmp_dir)
             try:
@@ -141,26 +142,17 @@ class MercurialSourceDownloader(AbstractSourceDownloader):
             logging.getLogger().info("Cloning {0}...".format(os.path.basename(self.url)))
             system.run_cmd("hg", ["clone", "--noupdate", self.url, self.hg_dir])
         else:
-            old_cwd = os.getcwd()
-            os.chdir(self.hg_dir)
-            
             logging.getLogger().info("Updating {0}...".format(os.path.basename(self.hg_dir)))
-            system.run_cmd("hg", ["pull"])
-            
-            os.chdir(old_cwd)
+            system.run_cmd("hg", ["pull"], cwd=self.hg_dir)
         
     def stage(self):
         if not os.path.exists(self.dest_dir):
             os.mkdir(self.dest_dir)
         
         if self._src_needs_update(self.dest_dir, self.hg_dir):
-            old_cwd = os.getcwd()
-            os.chdir(self.hg_dir)
-            
             logging.getLogger().info("Checking out {0}...".format(self.revision))        
-            system.run_cmd("hg",  ["archive", "-S", "-y", "-r", self.revision, "-t", "files", self.dest_dir])
-            
-            os.chdir(old_cwd)
+            system.run_cmd("hg",  ["archive", "-S", "-y", "-r", self.revision, "-t", "files", self.dest_dir],
+                           cwd=self.hg_dir)
     
 class SubversionSourceDownloader(AbstractSourceDownloader):
     def __init__(self, name, version, source_info):
@@ -182,13 +174,8 @@ class SubversionSourceDownloader(AbstractSourceDownloader):
             system.run_cmd("svn", options)
         else:
             if not self.revision:
-                old_cwd = os.getcwd()
-                os.chdir(self.svn_dir)
-                
                 logging.getLogger().info("Updating {0}...".format(os.path.basename(self.svn_dir)))
-                system.run_cmd("svn", ["up"])
-                
-                os.chdir(old_cwd)
+                system.run_cmd("svn", ["up"], cwd=self.svn_dir)
         
     def stage(self):
         if not os.path.exists(self.dest_dir):
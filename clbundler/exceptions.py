@@ -37,6 +37,15 @@ class SourceError(CLbundlerError):
 class BundleError(CLbundlerError):
     pass
     
+class BuildCacheError(CLbundlerError):
+    pass
+    
+class DependencyCycleError(CLbundlerError):
+    def __init__(self, cycle):
+        self.cycle = cycle
+    def __str__(self):
+        return "Dependency cycle: " + " -> ".join(self.cycle)
+    
 class BuildConfigError(CLbundlerError):
     def __init__(self, message, detail=""):
         self.message = message
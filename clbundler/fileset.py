@@ -1,23 +1,133 @@
 import os
 
 from clbundler import exceptions
+from clbundler import fileutils
+from clbundler import system
 from enum import Enum
 
 Categories = Enum("build", "build_dbg", "run", "run_dbg")
 
+def category_name(category):
+    """Return the name of a category value, e.g. 'run' for Categories.run"""
+    for name, value in vars(Categories).iteritems():
+        if value == category:
+            return name
+    raise exceptions.CLbundlerError("Unknown file category '{0}'".format(category))
+
+class CopyPlan(object):
+    """Everything a FileSet installs, as returned by FileSet.resolve()
+    
+    dirs is a list of directories to create and files is a list of
+    (src, dest, category) tuples. Destinations are relative to the bundle.
+    Copied directories are already expanded into the files they contain.
+    """
+    def __init__(self):
+        self.dirs = []
+        self.files = []
+    
+    def __len__(self):
+        return len(self.files)
+
 class FileSet(object):
     def __init__(self):
         self.files = dict([(c, []) for c in Categories])
         
     def add(self, patterns, dest, exclude=[], category=Categories.run):
         try:
-            patterns = [os.path.abspath(p) for p in patterns if not os.path.isabs(p)]
-            exclude = [os.path.abspath(p) for p in exclude if not os.path.isabs(p)]
-            self.files[category].append((patterns, exclude, dest))
+            #relative to the directory of the build, which is not the process' 
+            #directory when formulas are built in parallel
+            cwd = system.getcwd()
+            patterns = [os.path.abspath(os.path.join(cwd, p)) for p in patterns]
+            exclude = [os.path.abspath(os.path.join(cwd, p)) for p in exclude]
+            self.files[category].append((patterns, fileutils.PatternSet(exclude), dest))
         except KeyError as e:
             raise exceptions.CLbundlerError("Unknown file category '{}'".format(e.message))
     
     def iter_items(self, category):
         if not self.files.has_key(category):
-            raise exceptions.CLbundlerError("Unknown file category '{}'".format(e.message))
+            raise exceptions.CLbundlerError("Unknown file category '{}'".format(category))
         return iter(self.files[category])
+
+    def resolve(self):
+        """Find every file described by the FileSet and return a CopyPlan
+        
+        All patterns of all categories are matched in one walk of the file
+        system (see fileutils.glob_many()), instead of one walk per pattern.
+        When several entries copy to the same destination, the one added last
+        wins, as if the entries had been copied one after another.
+        """
+        rules = []
+        for category in Categories:
+            for patterns, exclude, dest in self.iter_items(category):
+                dest = os.path.normpath(dest).lstrip("/").lstrip("\\")
+                if dest == os.curdir:
+                    dest = ""
+                for pattern in patterns:
+                    rules.append((pattern, exclude, dest, category))
+        
+        dirs = set()
+        #dest -> (rule index, src, category)
+        files = {}
+        
+        def _add_file(rule_i, src, dest, category):
+            if dest not in files or files[dest][0] <= rule_i:
+                files[dest] = (rule_i, src, category)
+        
+        #one TreeFilter per entry, shared by its patterns
+        tree_filters = {}
+        
+        def _add_tree(rule_i, src, dest, category, exclude):
+            #same as copying the directory with shutil.copytree(src, dest, symlinks=True,
+            #ignore=fileutils.copy_ignore(exclude))
+            if id(exclude) not in tree_filters:
+                tree_filters[id(exclude)] = fileutils.TreeFilter(exclude)
+            tree_filter = tree_filters[id(exclude)]
+            
+            dirs.add(dest)
+            for dirpath, dirnames, filenames in fileutils.walk(src, follow_links=False):
+                rel_dir = os.path.relpath(dirpath, src)
+                dest_dir = dest if rel_dir == os.curdir else os.path.join(dest, rel_dir)
+                excluded = tree_filter.matching(dirpath, dirnames + filenames)
+                if excluded:
+                    dirnames[:] = [n for n in dirnames if n not in excluded]
+                dirs.update(os.path.join(dest_dir, n) for n in dirnames)
+                for n in filenames:
+                    if n not in excluded:
+                        _add_file(rule_i, os.path.join(dirpath, n), os.path.join(dest_dir, n), category)
+        
+        matches = fileutils.glob_many([(r[0], r[1]) for r in rules])
+        for path, indices in matches:
+            #like shutil.copytree(), a matched link to a directory is copied as a directory
+            is_dir = os.path.isdir(path)
+            path_segments = None
+            
+            for rule_i in indices:
+                pattern, exclude, dest, category = rules[rule_i]
+                pattern_segments = fileutils.compile_pattern(pattern).segments
+                
+                if not pattern.count("**"):
+                    target = os.path.join(dest, os.path.basename(path))
+                else:
+                    #strip the fixed portion of the path
+                    #we only want to keep the directory structure after the glob expression
+                    if path_segments is None:
+                        path_segments = fileutils.separate_path(path)
+                    new_root_i = pattern_segments.index("**")
+                    target = os.path.join(dest, *path_segments[new_root_i:])
+                    
+                    if pattern_segments[-1] == "**" and is_dir and not os.path.islink(path):
+                        #everything in the directory also matches the pattern
+                        #and is added separately
+                        dirs.add(target)
+                        continue
+                
+                if is_dir:
+                    _add_tree(rule_i, path, target, category, exclude)
+                else:
+                    _add_file(rule_i, path, target, category)
+        
+        plan = CopyPlan()
+        plan.dirs = sorted(dirs)
+        
+        plan.files = sorted((src, dest, category) for dest, (i, src, category) in files.iteritems())
+        return plan
@@ -1,9 +1,38 @@
 import os
+import re
+import stat
 import errno
 import shutil
 import time
-import fnmatch
+import hashlib
+import mmap
+import threading
+from collections import OrderedDict
 from glob import has_magic
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        #backport of os.scandir() for python 2
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+#files larger than this are hashed through a memory map instead of read()
+MMAP_THRESHOLD = 1024 * 1024
+
+#how copy_file() puts a file at its destination
+INSTALL_MODES = ("copy", "hardlink", "reflink", "move")
+
+#ioctl that makes a file share the data blocks of another (btrfs, xfs)
+_FICLONE = 0x40049409
 
 def makedirs(path, mode=0o777, exist_ok=False):
     """Create a directory, and ancestors if necessary.
@@ -19,7 +48,6 @@ def makedirs(path, mode=0o777, exist_ok=False):
 
 def rmtree_onerror(func, path, exc):
     """Handle deleting things on windows."""
-    import stat
     excvalue = exc[1]
     if func in (os.rmdir, os.remove) and excvalue.errno == errno.ENOTEMPTY:
         #Because windows sometimes keeps a directory alive for a little
@@ -76,19 +104,97 @@ def copy(src, dest, parents=False, replace=False, ignore=None):
         else:
             shutil.copy(src, dest)
 
+def copy_file(src, dest, mode="copy"):
+    """Copy a single file to the path dest, replacing it if it exists.
+    
+    Symbolic links are copied as links, even if they point to a directory.
+    Like shutil.copy2(), the permission bits and modification time of src 
+    are preserved.
+    
+    mode is one of INSTALL_MODES. Other than "copy", which copies the data, 
+    "hardlink" links dest to src, "reflink" clones the data blocks of src 
+    (copy on write) and "move" renames src to dest. These only change 
+    metadata, and fall back to "copy" when the file system does not support
+    them (or src and dest are on different file systems).
+    """
+    if mode not in INSTALL_MODES:
+        raise ValueError("Unknown install mode '{0}'".format(mode))
+    
+    #never write through an existing link or a hard link to another file
+    if os.path.islink(dest) or os.path.isfile(dest):
+        os.remove(dest)
+    
+    if os.path.islink(src):
+        if os.path.lexists(dest):
+            remove(dest)
+        os.symlink(os.readlink(src), dest)
+        return
+
+    try:
+        if mode == "hardlink" and hasattr(os, "link"):
+            os.link(src, dest)
+            return
+        if mode == "move":
+            os.rename(src, dest)
+            return
+        if mode == "reflink" and fcntl is not None:
+            with open(src, "rb") as fsrc:
+                with open(dest, "wb") as fdest:
+                    fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copystat(src, dest)
+            return
+    except (OSError, IOError):
+        pass
+    
+    with open(src, "rb") as fsrc:
+        with open(dest, "wb") as fdest:
+            shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
+    shutil.copystat(src, dest)
+
+def copy_files(pairs, workers=8, mode="copy"):
+    """Return a generator that yields (src, dest, st) for each (src, dest) in pairs
+    
+    Every src is copied to dest with copy_file() by a pool of worker threads, 
+    which is much faster than copying one file after another when there are 
+    many small files. The directories that contain dest must already exist. 
+    st is the os.lstat() result of dest after copying, and results are not 
+    in the same order as pairs.
+    
+    mode is passed to copy_file(). When mode is "move", a src that appears 
+    in more than one pair is copied instead.
+    """
+    pairs = list(pairs)
+    copied_srcs = set()
+    if mode == "move":
+        seen = set()
+        for src, dest in pairs:
+            if src in seen:
+                copied_srcs.add(src)
+            seen.add(src)
+    
+    def _copy(pair):
+        copy_file(pair[0], pair[1], "copy" if pair[0] in copied_srcs else mode)
+        return pair + (os.lstat(pair[1]),)
+    
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(_copy, pairs, 16):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
 def copy_ignore(patterns):
     """Return a function that can be used as shutil.copytree() ignore argument.
     
     All names that match one of the patterns according to match(), will be ignored.
     Note: the full path has to match, not just the name.
+    
+    The patterns are compiled once, and each directory is filtered with a 
+    TreeFilter, so the cost grows with the number of directories rather than
+    files times patterns.
     """
-    def _ignore(path, names):
-        ignored_names = []
-        for n in names:
-            if match_list(os.path.join(path, n), patterns):
-                ignored_names.append(n)
-        return set(ignored_names)
-    return _ignore
+    return TreeFilter(patterns).matching
     
 def separate_path(path):
     """Separate a path into its components"""
@@ -105,6 +211,273 @@ def separate_path(path):
     
     return components
 
+class _LRUCache(object):
+    """Dictionary-like cache that keeps the most recently used max_size items"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, create):
+        """Return the item for key, calling create(key) to make it if it is missing"""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                value = create(key)
+                if len(self._items) >= self.max_size:
+                    self._items.popitem(last=False)
+            self._items[key] = value
+            return value
+
+#fnmatch is case insensitive on platforms with case insensitive paths
+_pattern_flags = 0
+if os.path.normcase("A") == "a":
+    _pattern_flags = re.IGNORECASE
+
+def _normalize_path(path):
+    """Return path as segments joined and terminated by '/', the form compiled patterns match
+    
+    Like separate_path(), the drive, root and empty segments are dropped.
+    """
+    path = os.path.splitdrive(path)[1]
+    if os.altsep:
+        path = path.replace(os.altsep, os.sep)
+    segments = [p for p in path.split(os.sep) if p]
+    if not segments:
+        return ""
+    return "/".join(segments) + "/"
+
+def _translate_segment(segment):
+    """Translate one pattern segment to a regular expression.
+    
+    Like fnmatch.translate(), except that wildcards never match '/'.
+    """
+    i, n = 0, len(segment)
+    result = []
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == "*":
+            result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "[":
+            j = i
+            if j < n and segment[j] == "!":
+                j += 1
+            if j < n and segment[j] == "]":
+                j += 1
+            while j < n and segment[j] != "]":
+                j += 1
+            if j >= n:
+                result.append("\\[")
+            else:
+                chars = segment[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if chars[0] == "!":
+                    chars = "^/" + chars[1:]
+                elif chars[0] == "^":
+                    chars = "\\" + chars
+                result.append("[" + chars + "]")
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+class CompiledPattern(object):
+    """An Ant-style pattern (see match()) compiled into one regular expression
+    
+    For walking a directory tree one segment at a time, the pattern can also 
+    be used as a state machine: a state is the index of the next pattern 
+    segment to match, and advance() moves a set of states over one path segment.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.segments = separate_path(pattern)
+        
+        units = []
+        self._segment_sources = []
+        self._segment_regexes = []
+        self._literals = []
+        for segment in self.segments:
+            if segment == "**":
+                units.append("(?:[^/]+/)*")
+                self._segment_sources.append(None)
+                self._segment_regexes.append(None)
+                self._literals.append(None)
+            else:
+                source = _translate_segment(segment)
+                units.append(source + "/")
+                self._segment_sources.append(source)
+                self._segment_regexes.append(re.compile(source + "\\Z", _pattern_flags))
+                self._literals.append(segment if not has_magic(segment) else None)
+        self.source = "".join(units) + "\\Z"
+        self._regex = re.compile(self.source, _pattern_flags)
+    
+    def match(self, path):
+        return self._regex.match(_normalize_path(path)) is not None
+    
+    def closure(self, states):
+        """Return states plus the states reachable by letting '**' match nothing"""
+        result = set()
+        stack = list(states)
+        while stack:
+            i = stack.pop()
+            if i not in result:
+                result.add(i)
+                if i < len(self.segments) and self._segment_regexes[i] is None:
+                    stack.append(i + 1)
+        return frozenset(result)
+    
+    def advance(self, states, name):
+        """Return the states reached from states by matching the path segment name"""
+        next_states = []
+        for i in states:
+            if i < len(self.segments):
+                regex = self._segment_regexes[i]
+                if regex is None:
+                    next_states.append(i)
+                elif regex.match(name):
+                    next_states.append(i + 1)
+        return self.closure(next_states)
+    
+    def is_final(self, states):
+        """Return True if a path that reached states matches the whole pattern"""
+        return len(self.segments) in states
+    
+    def can_continue(self, states):
+        """Return True if a longer path could still match from states"""
+        return any(i < len(self.segments) for i in states)
+    
+    def last_segments(self, states):
+        """Return the source of the regular expression a name has to match to 
+        complete the pattern from states, or None if any name does ('**')
+        
+        Return an empty list if no name can complete the pattern.
+        """
+        n = len(self.segments)
+        sources = []
+        for i in states:
+            if i < n and n in self.closure([i + 1]):
+                if self._segment_sources[i] is None:
+                    return None
+                sources.append(self._segment_sources[i])
+        return sources
+    
+    def literals(self, states):
+        """Return the only names that can match from states, or None if wildcards are involved"""
+        names = set()
+        for i in states:
+            if i < len(self.segments):
+                if self._literals[i] is None:
+                    return None
+                names.add(self._literals[i])
+        return names
+
+class PatternSet(object):
+    """A list of Ant-style patterns that matches a path if any of the patterns do
+    
+    All patterns are combined into a single regular expression. Iterating 
+    over a PatternSet gives the original pattern strings, so it can be used 
+    anywhere a list of patterns is expected.
+    """
+    def __init__(self, patterns):
+        if isinstance(patterns, PatternSet):
+            patterns = patterns.patterns
+        self.patterns = [p if isinstance(p, CompiledPattern) else compile_pattern(p) 
+                         for p in patterns]
+        
+        self._regex = self._combine(self.patterns)
+        #a path that matches a pattern ending in '**' has all its descendants matched too
+        self._subtree_regex = self._combine([p for p in self.patterns 
+                                             if p.segments and p.segments[-1] == "**"])
+    
+    def match(self, path):
+        if self._regex is None:
+            return False
+        return self._regex.match(_normalize_path(path)) is not None
+    
+    def matches_subtree(self, path):
+        """Return True if path and everything below it is matched"""
+        if self._subtree_regex is None:
+            return False
+        return self._subtree_regex.match(_normalize_path(path)) is not None
+    
+    @staticmethod
+    def _combine(patterns):
+        if not patterns:
+            return None
+        source = "|".join("(?:{0})".format(p.source) for p in patterns)
+        return re.compile(source, _pattern_flags)
+    
+    def __iter__(self):
+        return iter([p.pattern for p in self.patterns])
+    
+    def __len__(self):
+        return len(self.patterns)
+
+class TreeFilter(object):
+    """Finds the names in a directory that match a PatternSet, one directory at a time
+    
+    The state of each pattern (see CompiledPattern) is computed once per 
+    directory from the state of its parent directory. Patterns that cannot 
+    match anything below a directory are dropped there. Deciding which 
+    names in a directory match then costs at most one regular expression 
+    per name. In a directory that no pattern can reach, it costs nothing. 
+    Where a pattern ending in '**' applies, every name matches without 
+    being looked at.
+    """
+    def __init__(self, patterns):
+        if not isinstance(patterns, PatternSet):
+            patterns = pattern_set(patterns)
+        self.patterns = patterns
+        #tuple of directory segments -> [(pattern, states)]
+        self._states = {(): [(p, p.closure([0])) for p in patterns.patterns]}
+        self._name_regexes = {}
+    
+    def matching(self, dirpath, names):
+        """Return the set of names in dirpath for which match_list(dirpath/name) is True"""
+        sources = set()
+        for pattern, states in self._dir_states(dirpath):
+            pattern_sources = pattern.last_segments(states)
+            if pattern_sources is None:
+                return set(names)
+            sources.update(pattern_sources)
+        if not sources:
+            return set()
+        
+        key = tuple(sorted(sources))
+        regex = self._name_regexes.get(key)
+        if regex is None:
+            regex = re.compile("(?:{0})\\Z".format("|".join(key)), _pattern_flags)
+            self._name_regexes[key] = regex
+        return set(n for n in names if regex.match(n))
+    
+    def _dir_states(self, dirpath):
+        segments = tuple(_normalize_path(dirpath).split("/")[:-1])
+        
+        #start from the closest ancestor that has been seen before
+        i = len(segments)
+        while segments[:i] not in self._states:
+            i -= 1
+        states = self._states[segments[:i]]
+        for j in range(i, len(segments)):
+            states = [(p, s) for p, s in ((p, p.advance(s, segments[j])) for p, s in states)
+                      if p.can_continue(s)]
+            self._states[segments[:j + 1]] = states
+        return states
+
+_pattern_cache = _LRUCache(512)
+_pattern_set_cache = _LRUCache(128)
+
+def compile_pattern(pattern):
+    """Return a CompiledPattern for pattern, reusing recently compiled patterns"""
+    return _pattern_cache.get(pattern, CompiledPattern)
+
+def pattern_set(patterns):
+    """Return a PatternSet for a list of patterns, reusing recently compiled sets"""
+    return _pattern_set_cache.get(tuple(patterns), PatternSet)
+
 def match(path, pattern):
     """
     Check if path matches pattern.
@@ -120,119 +493,274 @@ def match(path, pattern):
         **/test/** will match test, a/test, test/a, a/b/c/test/d/e, etc.
         dir/file_???.txt will match dir/file_abc.txt, but not dir/file_abcd.txt
         
-    fnmatch.fnmatch() is used for the actual matching, so character ranges can also be used.
-    """
-    path_segments = separate_path(path)
-    pattern_segments = separate_path(pattern)
-    path_length = len(path_segments)
-    pattern_length = len(pattern_segments)
-
-    i = 0
-    j = 0
-    while i < pattern_length and j < path_length:
-        if pattern_segments[i] == "**":
-            if i + 1 < pattern_length:
-                i += 1
-            else:
-                #the '**' is at the end, so any path segments after will be matched
-                return True
-                
-            #increment j until a path segment matches or we come to the end
-            while j < path_length:
-                #in case there are multiple path segments that would match,
-                #make sure we find a match with the correct number of segments remaining
-                equal_remaining = path_length - j == pattern_length - i
-                allow_different = pattern_segments[i:].count("**")
-                if (fnmatch.fnmatch(path_segments[j], pattern_segments[i]) and
-                    (equal_remaining or allow_different)):
-                    break
-                else:
-                    j += 1
-        else:
-            #normal segment by segment matching
-            if not fnmatch.fnmatch(path_segments[j], pattern_segments[i]):
-                return False
-            i += 1
-            j += 1
-            
-            #handle the special case of '**/x/**' when x is the last path segment.
-            #when i points to the last '**', j will already be one past the end, 
-            #so simply increment i again  
-            if i == pattern_length - 1 and pattern_segments[i] == "**":
-                if j == path_length:
-                    i += 1
-
-    #if we have reached here, it should mean that we have successfully 
-    #matched all segments
-    if i == pattern_length and j == path_length:
-        return True
-
-    return False
+    Character ranges can also be used, with the same syntax as fnmatch.
+    
+    The pattern is compiled with compile_pattern(), so matching many paths 
+    against the same pattern only compiles it once.
+    """
+    return compile_pattern(pattern).match(path)
 
 def match_list(path, patterns):
-    """Check if path matches any pattern in a list"""
-    for p in patterns:
-        if match(path, p):
-            return True
-    return False
+    """Check if path matches any pattern in a list
+    
+    patterns can be a list of patterns or a PatternSet.
+    """
+    if not isinstance(patterns, PatternSet):
+        patterns = pattern_set(patterns)
+    return patterns.match(path)
+    
+class _DirEntry(object):
+    """Stand-in for os.DirEntry when scandir is not available
     
-def walk(path, depth_limit=None):
+    Like a DirEntry, the result of stat() is cached, so an entry is stat'ed
+    at most once (twice for symbolic links that are followed).
+    """
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = None
+        self._stat = None
+    
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._lstat
+    
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+    
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+    
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(False).st_mode)
+        except OSError:
+            return False
+
+def scandir(path):
+    """Return a list with a DirEntry for each entry in the directory path
+    
+    Uses os.scandir() (or the scandir backport on python 2), where the file 
+    type comes with the directory listing on most platforms and is_dir() and
+    is_symlink() need no system call. Without it, entries are listed with 
+    os.listdir() and stat'ed when first needed.
+    """
+    if _scandir is not None:
+        return list(_scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+def walk(path, depth_limit=None, follow_links=True, entries=False):
     """Walk directory tree rooted at path
     
     For each directory, it yields (dirpath, dirnames, filenames).
     dirpath is the path of the directory being visited, dirnames is the list 
     of directories in dirpath and filenames is the list of files in dirpath. 
+    dirnames can be modified in place to prune the walk.
 
     If depth_limit is not None, the tree is only walked up to depth depth_limit. 
     For example, if depth_limit is 2, the contents of the root directory is returned, 
     and then the contents of the subdirectories of the root directory.
+    
+    If follow_links is False, symbolic links to directories are listed in 
+    filenames and are not walked into.
+    
+    If entries is True, dirnames and filenames are lists of DirEntry objects
+    (see scandir()) instead of names, whose stat() results are cached and can
+    be used without stat'ing the files again.
     """
-    def _walk_recursive(path, depth):
-        if depth_limit is None or depth < depth_limit:
-            try:
-                contents = os.listdir(path)
-            except OSError:
-                return
+    stack = [(path, 0)]
+    while stack:
+        dirpath, depth = stack.pop()
+        if depth_limit is not None and depth >= depth_limit:
+            continue
+        try:
+            contents = scandir(dirpath)
+        except OSError:
+            continue
                 
-            dirs = []
-            files = []
-            for name in contents:
-                subpath = os.path.join(path, name)
-                if os.path.isdir(subpath):
-                    dirs.append(name)
-                else:
-                    files.append(name)
+        dirs = []
+        files = []
+        for entry in contents:
+            if entry.is_dir() and (follow_links or not entry.is_symlink()):
+                dirs.append(entry)
+            else:
+                files.append(entry)
                 
-            yield path, dirs, files
-
-            for name in dirs:
-                for x in _walk_recursive(os.path.join(path, name), depth + 1):
-                    yield x
+        if entries:
+            yield dirpath, dirs, files
+            subdirs = [e.name for e in dirs]
+        else:
+            subdirs = [e.name for e in dirs]
+            yield dirpath, subdirs, [e.name for e in files]
 
-    for x in _walk_recursive(path, 0):
-        yield x
+        #pushed in reverse, so they are visited in listing order
+        stack.extend((os.path.join(dirpath, name), depth + 1) for name in reversed(subdirs))
 
-def glob(pattern):
+def glob(pattern, exclude=None):
     """Return a generator that yields paths matching pattern
     
     The matching is done with match(), so glob('src/**/*.h') will return 
     all .h files in the directory tree 'src'
+    
+    The tree is walked one pattern segment at a time, and a directory is only
+    entered if a path inside it can still match the pattern, so 'lib/**/*.a' 
+    never looks inside 'share'. Directories are not listed at all where the 
+    next segment has no wildcards.
+    
+    If exclude (a list of patterns or a PatternSet) is given, paths matching
+    it are not returned, and directories whose whole contents are excluded 
+    (for example by '**/test/**') are not entered.
     """
-    if os.path.exists(pattern):
-        yield pattern
-    else:
-        path = pattern
-        depth_limit = 0
-        while has_magic(path):
-            path, basename = os.path.split(path)
-            depth_limit += 1
-        if not path:
-            path = "."
-        if pattern.count("**"):
-            depth_limit = None
-
-        for parent, dirs, files in walk(path, depth_limit):
-            for p in dirs + files:
-                subpath = os.path.join(parent, p)
-                if match(subpath, pattern):
-                    yield subpath
+    for path, indices in glob_many([(pattern, exclude)]):
+        yield path
+    
+def glob_many(patterns):
+    """Like glob(), but for many patterns at once
+    
+    patterns is a list of (pattern, exclude) pairs, where exclude is None, a 
+    list of patterns or a PatternSet. Return a generator that yields 
+    (path, indices) for every path that matches at least one pattern, where 
+    indices is the list of positions in patterns of the patterns it matches.
+    
+    Patterns whose fixed prefixes are inside one another are matched in a 
+    single walk of the outermost prefix, so each directory is listed at most
+    once no matter how many patterns look at it.
+    """
+    compiled = []
+    excludes = []
+    existing = OrderedDict()
+    roots = {}
+    for i, (pattern, exclude) in enumerate(patterns):
+        if exclude is not None and not isinstance(exclude, PatternSet):
+            exclude = pattern_set(exclude)
+        compiled.append(compile_pattern(pattern))
+        excludes.append(exclude)
+        
+        if os.path.exists(pattern):
+            existing.setdefault(pattern, []).append(i)
+        else:
+            root = pattern
+            while has_magic(root):
+                root = os.path.split(root)[0]
+            roots.setdefault(root, []).append(i)
+        
+    def _excluded(i, path):
+        return excludes[i] is not None and excludes[i].match(path)
+            
+    for path, indices in existing.iteritems():
+        indices = [i for i in indices if not _excluded(i, path)]
+        if indices:
+            yield path, indices
+        
+    #walk each root that is not inside another one
+    walk_roots = OrderedDict()
+    #pattern index -> its root, for patterns walked from a directory above their root
+    merged_roots = {}
+    for root in sorted(roots, key=len):
+        for top in walk_roots:
+            if _is_within(root, top):
+                walk_roots[top].extend(roots[root])
+                if os.path.normpath(root) != os.path.normpath(top):
+                    merged_roots.update((i, os.path.normpath(root)) for i in roots[root])
+                break
+        else:
+            walk_roots[root] = list(roots[root])
+    
+    for top, indices in walk_roots.iteritems():
+        depth = len(separate_path(top))
+        stack = [(top, [(i, compiled[i].closure([depth])) for i in sorted(indices)])]
+        while stack:
+            dirpath, states = stack.pop()
+            
+            names = set()
+            for i, pattern_states in states:
+                literals = compiled[i].literals(pattern_states)
+                if literals is None:
+                    names = None
+                    break
+                names.update(literals)
+            if names is not None:
+                contents = [(n, None) for n in names if os.path.lexists(os.path.join(dirpath, n))]
+            else:
+                try:
+                    contents = [(e.name, e) for e in scandir(dirpath or os.curdir)]
+                except OSError:
+                    continue
+            
+            subdirs = []
+            for name, entry in contents:
+                path = os.path.join(dirpath, name)
+                matched = []
+                next_states = []
+                for i, pattern_states in states:
+                    reached = compiled[i].advance(pattern_states, name)
+                    if not reached:
+                        continue
+                    if (compiled[i].is_final(reached) and not _excluded(i, path) and
+                        #a walk of the root alone does not return the root itself
+                        (i not in merged_roots or os.path.normpath(path) != merged_roots[i])):
+                        matched.append(i)
+                    if (compiled[i].can_continue(reached) and 
+                        (excludes[i] is None or not excludes[i].matches_subtree(path))):
+                        next_states.append((i, reached))
+                
+                if matched:
+                    yield path, matched
+                if next_states and (entry.is_dir() if entry is not None else os.path.isdir(path)):
+                    subdirs.append((path, next_states))
+            
+            stack.extend(reversed(subdirs))
+
+def _is_within(path, top):
+    """Return True if path is top or below it, comparing the strings only"""
+    if not top:
+        return not os.path.isabs(path)
+    return path == top or path.startswith(top.rstrip(os.sep) + os.sep)
+
+def file_digest(path):
+    """Return the hex SHA-256 digest of a file's contents.
+    
+    Symbolic links are not followed, the digest of a link is computed from 
+    its target path.
+    """
+    h = hashlib.sha256()
+    if os.path.islink(path):
+        h.update(os.readlink(path))
+        return h.hexdigest()
+        
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                h.update(m)
+            finally:
+                m.close()
+        else:
+            h.update(f.read())
+    return h.hexdigest()
+
+def digest_files(paths, workers=8):
+    """Return a generator that yields (path, digest) for each path.
+    
+    Files are hashed concurrently by a pool of worker threads, so the results
+    are not in the same order as paths.
+    """
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(lambda p: (p, file_digest(p)), paths, 16):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
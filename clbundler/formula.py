@@ -1,5 +1,6 @@
 import os
 import sys
+import inspect
 import logging
 
 from fileset import Categories, FileSet
@@ -10,10 +11,14 @@ class Formula(object):
     def __init__(self, context, options={}):
         self.context = context
         self.name = type(self).__name__
-        self.dir = os.path.abspath(
-            os.path.dirname(sys.modules[type(self).__module__].__file__))
+        #__file__ is the .pyc once the formula has been compiled, the build
+        #cache fingerprints the source
+        self.file = os.path.abspath(inspect.getsourcefile(type(self)) or 
+                                    sys.modules[type(self).__module__].__file__)
+        self.dir = os.path.dirname(self.file)
         self.is_kit = False
         
+        self._option_names = []
         self.add_option("variant", "release")
         self.set_options(options)
         
@@ -21,8 +26,14 @@ class Formula(object):
         self.patches = []
     
     def add_option(self, name, default_value):
+        if name not in self._option_names:
+            self._option_names.append(name)
         setattr(self, name, default_value)
     
+    def option_values(self):
+        """Return a dict with the current value of each option"""
+        return dict((name, getattr(self, name)) for name in self._option_names)
+    
     def get_option(name):
         try:
             return getattr(self, name)
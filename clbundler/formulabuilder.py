@@ -1,7 +1,12 @@
 import os
+import copy
 import logging
 import time
 import shutil
+import threading
+import tarfile
+import Queue
+from multiprocessing.pool import ThreadPool
 
 from enum import Enum
 import formulamanager
@@ -9,8 +14,12 @@ import sourcemanager
 import exceptions
 import env
 from graph import Graph
+from fileset import category_name
 import config 
+import trash
+import system
 import fileutils
+import buildcache
 
 class BuildContext:
     def __init__(self, bundle_path, toolchain, arch):
@@ -22,11 +31,32 @@ class BuildContext:
         self.workspace_dir = config.global_config().workspace_dir()
         self.install_dir = os.path.join(self.workspace_dir, "tmp_install")
         
+class BuildJob:
+    """A formula that needs to be built, and how to install it"""
+    def __init__(self, formula, context):
+        self.formula = formula
+        self.context = context
+        self.force = False
+        self.clean_src = False
+        self.dry_run = False
+        self.install_mode = None
+        self.checksum = False
+        self.use_cache = True
+        self.fingerprint = None
+        #installed, but built from a different fingerprint
+        self.outdated = False
+
 class FormulaBuilder:
     def __init__(self, bundle):
         self._bundle = bundle
         self._context = BuildContext(bundle.path, bundle.toolchain, bundle.arch)
         
+        self._hook_lock = threading.Lock()
+        
+        self._build_cache = buildcache.local_cache()
+        #formula name -> build fingerprint
+        self._fingerprints = {}
+        
         self.hooks = Enum("pre_build","post_build", "post_install")
         self._hook_functions = {self.hooks.pre_build:set(), 
                                 self.hooks.post_build:set(),
@@ -48,130 +78,361 @@ class FormulaBuilder:
         self._hook_functions[hook].remove(function)
     
     def _call_hook_functions(self, hook):
-        for f in self._hook_functions[hook]:
-            f()
+        #hooks are not expected to be thread safe
+        with self._hook_lock:
+            for f in self._hook_functions[hook]:
+                f()
       
     def install(self, formula_spec, options):
         formula_name, formula_path = formulamanager.parse_specifier(formula_spec)
         
-        if not self._bundle.is_installed(formula_name) or options.force:
+        if not self._bundle.is_installed(formula_name) or options.force or options.update:
             self._dep_graph = Graph()
             self._create_dep_graph(formula_name, formula_path)
             
             env.setup_env(self._context.toolchain, self._context.arch)
             self._context.env = env.env
             
-            #install dependencies
-            self._dep_graph.traverse(self._install, callback_args={"variant":options.variant})
+            #dependencies first, formula_name comes last
+            order = self._dep_graph.topological_sort()
+            dep_args = {"variant":options.variant, "install_mode":options.install_mode,
+                        "no_cache":options.no_cache, "update":options.update}
+            
+            if options.dry_run:
+                self._dry_run(formula_name, order, options, dep_args)
+            elif getattr(options, "jobs", 1) > 1:
+                self._install_parallel(formula_name, order, options, dep_args)
+            else:
+                jobs = [self._prepare(name, **dep_args) for name in order[:-1]]
+                jobs.append(self._prepare(formula_name, **vars(options)))
+                self._prefetch(jobs)
+                
+                #install dependencies, then formula_name
+                for job in jobs:
+                    if job is not None:
+                        self._install(job)
             
-            self._install(formula_name, **vars(options))
+            if options.force:
+                dependents = self._bundle.reverse_deps(formula_name)
+                if dependents:
+                    logging.getLogger().info("These packages depend on {0} and may need to be "
+                                             "rebuilt: {1}".format(formula_name, ", ".join(dependents)))
         else:
             print("{0} is already installed".format(formula_name))
         
     
     def uninstall(self, name, keep_dependent=False):
         if self._bundle.is_installed(name):
-            dep_graph = Graph()
-            installed = self._bundle.list_installed()
-            
-            for n in installed:
-                dep_graph.add_node(n[0], self._bundle.deps(n[0]))
-            
-            node = dep_graph.get_node(name)
-            
-            if not keep_dependent and node.parents:
-                #first uninstall packages that require this package
-                logging.getLogger().info("The following packages depend on {0} "
-                                         "and will also be uninstalled:".format(name))
-                logging.getLogger().info(", ".join(node.parents))
-                for n in node.parents:
-                    logging.getLogger().info("Uninstalling {0}...".format(n))
-                    self._bundle.uninstall(n)
+            dependents = []
+            if not keep_dependent:
+                dependents = self._bundle.reverse_deps(name)
             
-            logging.getLogger().info("Uninstalling {0}...".format(name))
-            self._bundle.uninstall(name)
+            with self._bundle.transaction():
+                if dependents:
+                    #first uninstall packages that require this package
+                    logging.getLogger().info("The following packages depend on {0} "
+                                             "and will also be uninstalled:".format(name))
+                    logging.getLogger().info(", ".join(dependents))
+                    for n in dependents:
+                        logging.getLogger().info("Uninstalling {0}...".format(n))
+                        self._bundle.uninstall(n)
+                
+                logging.getLogger().info("Uninstalling {0}...".format(name))
+                self._bundle.uninstall(name)
             logging.getLogger().info("Done")
         else:
             print("{0} is not installed".format(name))
     
-    def _install(self, formula_name, **kwargs):
+    def _dry_run(self, formula_name, order, options, dep_args):
+        """Build formula_name and show which files would be installed
+        
+        Dependencies are never built or installed. The formula is built against 
+        the dependencies in the bundle, so a dry run is refused if any of them
+        are not installed, and dependencies that would be rebuilt are listed.
+        """
+        missing = []
+        outdated = []
+        for name in order[:-1]:
+            job = self._prepare(name, **dep_args)
+            if job is not None:
+                if job.outdated:
+                    outdated.append(name)
+                else:
+                    missing.append(name)
+        if missing:
+            raise exceptions.BundleError("A dry run of {0} needs its dependencies installed, "
+                                         "missing: {1}".format(formula_name, ", ".join(missing)))
+        if outdated:
+            print("These dependencies would be rebuilt first: {0}".format(", ".join(outdated)))
+            print("{0} is built against the installed versions".format(formula_name))
+        
+        job = self._prepare(formula_name, **vars(options))
+        if job is not None:
+            self._install(job)
+    
+    def _install(self, job):
+        old_cwd = system.getcwd()
+        
+        fileset = self._build(job)
+        self._finish(job, fileset)
+        
+        system.chdir(old_cwd)
+    
+    def _install_parallel(self, formula_name, order, options, dep_args):
+        """Build formula_name and its dependencies on up to options.jobs threads
+        
+        A formula is scheduled as soon as all of its dependencies are installed,
+        so independent formulas build at the same time. Every build gets its own
+        copy of the BuildContext, with its own install_dir and environment, and
+        its own working directory (see system.thread_dir()). Builds are installed
+        into the bundle one at a time by the calling thread, which also owns the
+        bundle's manifest connection.
+        """
+        jobs = {}
+        for name in order:
+            if name == formula_name:
+                jobs[name] = self._prepare(name, **vars(options))
+            else:
+                jobs[name] = self._prepare(name, **dep_args)
+            if jobs[name] is not None:
+                jobs[name].context = self._formula_context(jobs[name].formula)
+        
+        self._prefetch(jobs.values())
+        
+        results = Queue.Queue()
+        def _run(job):
+            try:
+                with system.thread_dir(system.getcwd(), job.context.env):
+                    fileset = self._build(job)
+            except Exception as e:
+                results.put((job, None, e))
+            else:
+                results.put((job, fileset, None))
+        
+        scheduler = self._dep_graph.scheduler()
+        ready = scheduler.ready()
+        running = 0
+        error = None
+        pool = ThreadPool(options.jobs)
+        try:
+            while ready or running:
+                while ready and error is None:
+                    name = ready.pop()
+                    if jobs[name] is None:
+                        #nothing to build, its dependents can go ahead
+                        scheduler.done(name)
+                        ready.extend(scheduler.ready())
+                    else:
+                        pool.apply_async(_run, (jobs[name],))
+                        running += 1
+                if not running:
+                    break
+                
+                #a timeout keeps the wait interruptible with Ctrl+C on Python 2
+                job, fileset, e = results.get(True, 365 * 24 * 3600)
+                running -= 1
+                if e is not None:
+                    logging.getLogger().error("Building {0} failed".format(job.formula.name))
+                    if error is None:
+                        error = e
+                    continue
+                
+                self._finish(job, fileset)
+                scheduler.done(job.formula.name)
+                ready.extend(scheduler.ready())
+        except:
+            #an install failed or Ctrl+C, do not start the builds that are queued
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            #no build may keep running once the caller unwinds (and rolls back)
+            pool.join()
+        
+        if error is not None:
+            raise error
+    
+    def _prefetch(self, jobs):
+        """Download the builds of jobs that are in the shared build cache, several at a time"""
+        if self._build_cache is not None:
+            self._build_cache.prefetch([job.fingerprint for job in jobs 
+                                        if job is not None and job.use_cache])
+    
+    
+    def _formula_context(self, formula):
+        """Return a copy of the BuildContext for building formula in parallel with others"""
+        context = copy.copy(self._context)
+        context.env = dict(self._context.env)
+        context.install_dir = os.path.abspath(os.path.join(self._context.workspace_dir, 
+                                                           "tmp_install", formula.name))
+        return context
+    
+    def _prepare(self, formula_name, **kwargs):
+        """Return a BuildJob for formula_name, or None if it does not need to be built"""
         formula = formulamanager.get(formula_name, self._context)
+        job = BuildJob(formula, self._context)
         formula_options = {}
-        force_install = False
-        clean_src = False
         
         if kwargs.has_key("formula_options"):
             formula_options = kwargs["formula_options"]
         if kwargs.has_key("variant"):
             formula_options["variant"] = kwargs["variant"]
         if kwargs.has_key("force"):
-            force_install = kwargs["force"]
+            job.force = kwargs["force"]
         if kwargs.has_key("clean_src"):
-            clean_src = kwargs["clean_src"]
+            job.clean_src = kwargs["clean_src"]
+        if kwargs.has_key("dry_run"):
+            job.dry_run = kwargs["dry_run"]
+        if kwargs.has_key("install_mode"):
+            job.install_mode = kwargs["install_mode"]
+        if not job.install_mode:
+            job.install_mode = config.global_config().install_mode()
+        if kwargs.has_key("checksum"):
+            job.checksum = kwargs["checksum"]
+        if kwargs.get("no_cache") or kwargs.get("interactive"):
+            job.use_cache = False
         
         formula.set_options(formula_options)
         
-        if not formula.is_kit and (force_install or not self._bundle.is_installed(formula.name)):
-            if clean_src:
-                build_src_dir = os.path.join(self._context.build_dir, "{0}-{1}".format(formula.name, formula.version))
-                if os.path.exists(build_src_dir):
-                    fileutils.remove(build_src_dir)
+        if formula.is_kit:
+            return None
+        
+        job.fingerprint = self._fingerprint(formula)
+        if not job.force and self._bundle.is_installed(formula.name):
+            #with update, rebuild packages that were built from different inputs. The
+            #fingerprint includes those of the dependencies, so a package is also
+            #rebuilt when any of its dependencies is
+            if not kwargs.get("update") or self._bundle.fingerprint(formula.name) == job.fingerprint:
+                return None
+            job.force = True
+            job.outdated = True
+        return job
+    
+    def _fingerprint(self, formula):
+        """Return the build fingerprint of formula, see buildcache.fingerprint()"""
+        if not self._fingerprints.has_key(formula.name):
+            dep_fingerprints = {}
+            for name in formula.depends_on:
+                dep_fingerprints[name] = self._fingerprint(formulamanager.get(name, self._context))
+            patches = []
+            if formula.patches:
+                patches = sourcemanager.find_patches(formula.patches, self._patch_dirs(formula))
             
-            src_dir = sourcemanager.get_source(config.global_config().build_dir(), 
-                                               formula.name, formula.version, formula.source)
+            self._fingerprints[formula.name] = buildcache.fingerprint(formula, self._context, 
+                                                                      patches, dep_fingerprints)
+        return self._fingerprints[formula.name]
+    
+    def _patch_dirs(self, formula):
+        """Return the directories to search for the patches of formula"""
+        path1 = os.path.join(formula.dir, "patches", formula.name)
+        if formula.dir.endswith(config.os_name()):
+            path2 = os.path.normpath(os.path.join(formula.dir, "..", "patches", formula.name))
+        else:
+            path2 = os.path.join(formula.dir, config.os_name(), "patches", formula.name)
+        return [path1, path2]
             
-            old_cwd = os.getcwd()
-            os.chdir(src_dir)
+    def _build(self, job):
+        """Get the source of job's formula and build it, return the FileSet to install
             
-            if formula.patches:
-                path1 = os.path.join(formula.dir, "patches", formula.name)
-                if formula.dir.endswith(config.os_name()):
-                    path2 = os.path.normpath(os.path.join(formula.dir, "..", "patches", formula.name))
-                else:
-                    path2 = os.path.join(formula.dir, config.os_name(), "patches", formula.name)
-                patch_dirs = [path1, path2]
-                
-                sourcemanager.patch_source(formula.patches, patch_dirs, src_dir) 
+        A build with the same fingerprint is restored from the build cache instead.
+        Leaves the current directory (see system.chdir()) in the source directory.
+        """
+        formula = job.formula
+        context = job.context
+        formula.context = context
+        
+        if job.outdated:
+            logging.getLogger().info("{0} has changed since it was installed".format(formula.name))
+        
+        if job.use_cache and self._build_cache is not None:
+            self._clean_install_dir(context)
+            fileset = self._build_cache.get(job.fingerprint, context.install_dir)
+            if fileset is not None:
+                logging.getLogger().info("Restored {0} from the build cache".format(formula.name))
+                return fileset
             
-            #make sure we have clean install dir for each formula 
-            if os.path.exists(self._context.install_dir):
-                fileutils.remove(self._context.install_dir)
-            try:
-                os.mkdir(self._context.install_dir)
-            except OSError:
-                #On Windows, it is sometimes necessary to wait a little after deleting a 
-                #directory before creating it again
-                time.sleep(0.01)
-                os.mkdir(self._context.install_dir)
+        if job.clean_src:
+            build_src_dir = os.path.join(context.build_dir, "{0}-{1}".format(formula.name, formula.version))
+            if os.path.exists(build_src_dir):
+                trash.discard(build_src_dir)
                 
-            self._call_hook_functions(self.hooks.pre_build)
-            logging.getLogger().info("Building {0}...".format(formula.name))
+        src_dir = sourcemanager.get_source(config.global_config().build_dir(), 
+                                           formula.name, formula.version, formula.source)
             
-            fileset = formula.build()
+        system.chdir(src_dir)
+                
+        if formula.patches:
+            sourcemanager.patch_source(formula.patches, self._patch_dirs(formula), src_dir) 
             
-            self._call_hook_functions(self.hooks.post_build)
-            logging.getLogger().info("Done")
+        #make sure we have clean install dir for each formula 
+        self._clean_install_dir(context)
+        
+        self._call_hook_functions(self.hooks.pre_build)
+        logging.getLogger().info("Building {0}...".format(formula.name))
+        
+        fileset = formula.build()
+        
+        self._call_hook_functions(self.hooks.post_build)
+        logging.getLogger().info("Done building {0}".format(formula.name))
+        
+        #builds with --no-cache or --interactive may differ from a clean build, and
+        #a dry run is not supposed to change anything
+        if job.use_cache and not job.dry_run and self._build_cache is not None:
+            try:
+                self._build_cache.put(job.fingerprint, fileset, {"name":formula.name, 
+                                                                 "version":formula.version,
+                                                                 "toolchain":context.toolchain,
+                                                                 "arch":context.arch})
+            except (exceptions.BuildCacheError, EnvironmentError, tarfile.TarError) as e:
+                #the build itself is fine
+                logging.getLogger().warning("Could not add {0} to the build cache: "
+                                            "{1}".format(formula.name, e))
+        
+        return fileset
+    
+    def _clean_install_dir(self, context):
+        if os.path.exists(context.install_dir):
+            trash.discard(context.install_dir)
+        fileutils.makedirs(os.path.dirname(context.install_dir), exist_ok=True)
+        try:
+            os.mkdir(context.install_dir)
+        except OSError:
+            #On Windows, it is sometimes necessary to wait a little after deleting a 
+            #directory before creating it again
+            time.sleep(0.01)
+            os.mkdir(context.install_dir)
+    
+    def _finish(self, job, fileset):
+        """Install the FileSet built for job into the bundle (or only print it for a dry run)"""
+        formula = job.formula
+        if job.dry_run:
+            plan = fileset.resolve()
+            for src, dest, category in plan.files:
+                print("{0}: {1} -> {2}".format(category_name(category), src, dest))
+            print("{0} files would be installed".format(len(plan)))
+        else:
             logging.getLogger().info("Installing {0}...".format(formula.name))
             
-            self._bundle.install(formula.name, formula.version, formula.depends_on.keys(), fileset, force_install)
+            self._bundle.install(formula.name, formula.version, formula.depends_on.keys(), fileset, 
+                                 job.force, job.install_mode, job.checksum, job.fingerprint)
             
             self._call_hook_functions(self.hooks.post_install)
             logging.getLogger().info("Done")
-            
-            os.chdir(old_cwd)
 
     def _create_dep_graph(self, formula_name, formula_path=[]):
-        def _add_node(graph, formula):
-            for dep_name, options in formula.depends_on.iteritems():
-                dep_formula = formulamanager.get(dep_name, self._context, options, formula_path)
-                _add_node(self._dep_graph, dep_formula)
-                
-            self._dep_graph.add_node(formula.name, formula.depends_on.keys())
-          
+        """Add formula_name and everything it depends on to the dependency graph"""
         formula = formulamanager.get(formula_name, self._context, search_path=formula_path)
-        for dep_name, options in formula.depends_on.iteritems():
-            _add_node(self._dep_graph, formulamanager.get(dep_name, self._context, options, 
-                                                          formula_path))
+        seen = set([formula.name])
+        stack = [formula]
+        while stack:
+            formula = stack.pop()
+            self._dep_graph.add_node(formula.name, formula.depends_on.keys())
+            for dep_name, options in formula.depends_on.iteritems():
+                #seen also stops at dependency cycles, which topological_sort() reports
+                if dep_name not in seen:
+                    seen.add(dep_name)
+                    stack.append(formulamanager.get(dep_name, self._context, options, formula_path))
         
         
 
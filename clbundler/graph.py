@@ -1,4 +1,7 @@
 import logging
+from collections import deque
+
+import exceptions
 
 class Node:
     def __init__(self, name, children=None, parents=None):
@@ -9,7 +12,6 @@ class Node:
             parents = set()
         self.children = children
         self.parents = parents
-        self.marked = False
     def __eq__(self, other):
         if not isinstance(other, Node):
             return False
@@ -20,6 +22,12 @@ class Node:
         return hash(self.name)
 
 class Graph:
+    """A directed acyclic graph of dependencies
+    
+    The children of a node are the nodes it depends on, its parents are the
+    nodes that depend on it. Orders returned by the graph put children before
+    their parents.
+    """
     def __init__(self):
         self._graph = {}
     
@@ -33,28 +41,14 @@ class Graph:
             children = set()
         if parents is None:
             parents = set()
-        if not isinstance(children, set):
-            children = set(children)
-        if not isinstance(parents, set):
-            parents = set(parents)
         
-        if self._graph.has_key(name):
-            if children:
-                self._graph[name].children = self._graph[name].children.union(children)
-            if parents:
-                self._graph[name].parents = self._graph[name].children.union(parents)
-        else:
-            node = Node(name, children, parents)
-            self._graph[name] = node
-            if children:
-                for n in children:
-                    if not self.has_node(n):
-                        self._graph[n] = Node(n)
-                    self._graph[n].parents.add(name)
-            if parents:
-                for n in parents:
-                    if not self.has_node(n):
-                        self._graph[n] = Node(n)
+        node = self._get_or_add(name)
+        for n in children:
+            node.children.add(n)
+            self._get_or_add(n).parents.add(name)
+        for n in parents:
+            node.parents.add(n)
+            self._get_or_add(n).children.add(name)
     
     def get_node(self, name):
         if self.has_node(name):
@@ -75,17 +69,103 @@ class Graph:
                 root_nodes.append(self._graph[k])
         return root_nodes
     
+    def closure(self, start_nodes=[]):
+        """Return the set of start_nodes and everything they depend on (all nodes if empty)"""
+        if not start_nodes:
+            return set(self._graph.keys())
+        
+        reached = set(start_nodes)
+        stack = list(reached)
+        while stack:
+            for n in self._graph[stack.pop()].children:
+                if n not in reached:
+                    reached.add(n)
+                    stack.append(n)
+        return reached
+    
+    def in_degrees(self, start_nodes=[]):
+        """Return a dict with the number of dependencies of each node in closure(start_nodes)"""
+        return dict((n, len(self._graph[n].children)) for n in self.closure(start_nodes))
+    
+    def scheduler(self, start_nodes=[]):
+        """Return a Scheduler for closure(start_nodes)
+        
+        Raises DependencyCycleError if the nodes have a cycle.
+        """
+        return Scheduler(self, start_nodes)
+    
+    def levels(self, start_nodes=[]):
+        """Return closure(start_nodes) as a list of lists
+        
+        The first list has the nodes without dependencies, every following list
+        the nodes whose dependencies are all in earlier lists. The nodes of one
+        level do not depend on each other.
+        """
+        scheduler = self.scheduler(start_nodes)
+        levels = []
+        level = scheduler.ready()
+        while level:
+            levels.append(level)
+            for n in level:
+                scheduler.done(n)
+            level = scheduler.ready()
+        return levels
+    
+    def topological_sort(self, start_nodes=[]):
+        """Return closure(start_nodes) as a list in which every node comes after its dependencies
+        
+        Raises DependencyCycleError if the nodes have a cycle.
+        """
+        scheduler = self.scheduler(start_nodes)
+        order = []
+        ready = deque(scheduler.ready())
+        while ready:
+            n = ready.popleft()
+            order.append(n)
+            scheduler.done(n)
+            ready.extend(scheduler.ready())
+        return order
+    
+    def find_cycle(self, start_nodes=[]):
+        """Return a list of nodes that form a cycle, starting and ending with the same node,
+        or None if closure(start_nodes) has no cycle
+        """
+        waiting = self.in_degrees(start_nodes)
+        ready = [n for n, count in waiting.iteritems() if not count]
+        while ready:
+            for parent in self._graph[ready.pop()].parents:
+                if parent in waiting:
+                    waiting[parent] -= 1
+                    if not waiting[parent]:
+                        ready.append(parent)
+        
+        #every node that is left depends on a node that is left, so following
+        #dependencies from any of them ends up in a cycle
+        remaining = set(n for n, count in waiting.iteritems() if count)
+        if not remaining:
+            return None
+        path = [min(remaining)]
+        positions = {path[0]:0}
+        while True:
+            n = min(c for c in self._graph[path[-1]].children if c in remaining)
+            if n in positions:
+                return path[positions[n]:] + [n]
+            positions[n] = len(path)
+            path.append(n)
+    
     def traverse(self, callback=None, callback_args={}, start_nodes=[]):
-        """Perform a depth first traversal of the graph."""
-        for k in self._graph.keys():
-            self._graph[k].marked = False
+        """Call callback for each node, after it has been called for the node's dependencies
         
-        if not start_nodes:
-            start_nodes = self._graph.keys()
-            #start_nodes = ["shiboken"]
+        Only the nodes in closure(start_nodes) are visited.
+        """
+        for n in self.topological_sort(start_nodes):
+            if callback:
+                callback(n, **callback_args)
         
-        for n in start_nodes:
-            self._visit(n, callback, callback_args)
+    def _get_or_add(self, name):
+        if not self._graph.has_key(name):
+            self._graph[name] = Node(name)
+        return self._graph[name]
     
     def _print_node(self, name):
         node = self.get_node(name)
@@ -94,13 +174,50 @@ class Graph:
         print("children: " + ", ".join(node.children))
         print("parents: " + ", ".join(node.parents))
         
-    def _visit(self, name, callback=None, callback_args={}):
-        if not self._graph[name].marked:
-            for n in self._graph[name].children:
-                if not self._graph[n].marked:
-                    self._visit(n, callback, callback_args)
-                
-            self._graph[name].marked = True
-            if callback:
-                callback(name, **callback_args)        
-
+class Scheduler:
+    """Hands out the nodes of a Graph as their dependencies are done (Kahn's algorithm)
+    
+    ready() returns the nodes that can be processed now, done() marks a node
+    as processed, which makes the nodes whose last dependency it was ready.
+    The number of dependencies that are not done is kept for every node, so
+    done() only touches the node's parents, and a parallel build can start a
+    node as soon as its last dependency finishes.
+    """
+    def __init__(self, graph, start_nodes=[]):
+        cycle = graph.find_cycle(start_nodes)
+        if cycle is not None:
+            raise exceptions.DependencyCycleError(cycle)
+        
+        self._graph = graph
+        #number of dependencies of each node that are not done yet
+        self._waiting = graph.in_degrees(start_nodes)
+        self._ready = sorted(n for n, count in self._waiting.iteritems() if not count)
+        self._pending = len(self._waiting)
+    
+    def __len__(self):
+        """Return the number of nodes that are not done yet"""
+        return self._pending
+    
+    def in_degree(self, name):
+        """Return the number of dependencies of name that are not done yet"""
+        return self._waiting[name]
+    
+    def ready(self):
+        """Return the nodes whose dependencies are all done that were not returned yet"""
+        ready = self._ready
+        self._ready = []
+        return ready
+    
+    def done(self, name):
+        """Mark name as done"""
+        if self._waiting[name]:
+            raise exceptions.CLbundlerError("{0} is not ready or already done".format(name))
+        #-1 so that it is never ready again
+        self._waiting[name] = -1
+        self._pending -= 1
+        
+        for parent in sorted(self._graph.get_node(name).parents):
+            if parent in self._waiting:
+                self._waiting[parent] -= 1
+                if not self._waiting[parent]:
+                    self._ready.append(parent)
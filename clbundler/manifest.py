@@ -0,0 +1,187 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import exceptions
+
+def _create_tables(m):
+    m.execute("CREATE TABLE installed"
+              "(id INTEGER PRIMARY KEY AUTOINCREMENT,"
+              "name TEXT UNIQUE, version TEXT)")
+    m.execute("CREATE TABLE files (id INT, name TEXT, category TEXT)")
+    m.execute("CREATE TABLE dep_graph (name TEXT, deps TEXT)")
+    m.execute("CREATE TABLE info (platform TEXT, toolchain TEXT, arch TEXT)")
+
+def _add_indexes(m):
+    m.execute("CREATE TABLE schema_version (version INTEGER)")
+    m.execute("INSERT INTO schema_version VALUES (0)")
+    m.execute("CREATE INDEX files_id_category ON files (id, category)")
+    m.execute("CREATE INDEX files_name ON files (name)")
+    m.execute("CREATE INDEX dep_graph_name ON dep_graph (name)")
+    m.execute("CREATE INDEX dep_graph_deps ON dep_graph (deps)")
+
+def _add_file_stats(m):
+    m.execute("ALTER TABLE files ADD COLUMN size INTEGER")
+    m.execute("ALTER TABLE files ADD COLUMN mtime REAL")
+    m.execute("ALTER TABLE files ADD COLUMN digest TEXT")
+
+def _split_file_paths(m):
+    #files.name becomes the base name, the directory is stored once in dirs.
+    #dirs.path is relative to the bundle and ends with a separator ('' is the root),
+    #so the full path is always dirs.path || files.name
+    rows = m.fetchall("SELECT id, name, category, size, mtime, digest FROM files")
+    m.execute("DROP TABLE files")
+    m.execute("CREATE TABLE dirs (id INTEGER PRIMARY KEY, path TEXT UNIQUE)")
+    m.execute("CREATE TABLE files (id INT, dir INT, name TEXT, category TEXT,"
+              "size INTEGER, mtime REAL, digest TEXT)")
+    m.execute("CREATE INDEX files_id_category ON files (id, category)")
+    m.execute("CREATE INDEX files_dir_name ON files (dir, name)")
+    m.execute("CREATE VIEW file_paths AS "
+              "SELECT files.rowid AS file_id, files.id AS id, dirs.path || files.name AS name,"
+              "category, size, mtime, digest FROM files JOIN dirs ON files.dir = dirs.id")
+    
+    entries = []
+    for row in rows:
+        head, tail = os.path.split(row[1])
+        if head:
+            head += os.sep
+        entries.append((head, tail, row))
+    dir_ids = m.intern_dirs(e[0] for e in entries)
+    m.executemany("INSERT INTO files VALUES (?,?,?,?,?,?,?)",
+                  ((row[0], dir_ids[prefix], name) + tuple(row[2:]) 
+                   for prefix, name, row in entries))
+
+def _add_object_store(m):
+    #info.objects is 1 if identical files are stored once in the bundle's object store
+    m.execute("ALTER TABLE info ADD COLUMN objects INTEGER NOT NULL DEFAULT 0")
+    m.execute("CREATE INDEX files_digest ON files (digest)")
+
+def _add_build_fingerprints(m):
+    #fingerprint of the formula build a package was installed from (see buildcache.fingerprint()),
+    #NULL for packages installed before fingerprints were recorded
+    m.execute("ALTER TABLE installed ADD COLUMN fingerprint TEXT")
+
+#_migrations[i] upgrades a manifest from schema version i to i + 1.
+#Version 0 is the original layout, which has no schema_version table.
+_migrations = [_add_indexes, _add_file_stats, _split_file_paths, _add_object_store,
+               _add_build_fingerprints]
+
+SCHEMA_VERSION = len(_migrations)
+
+class Manifest(object):
+    """A session with a bundle's MANIFEST.db
+
+    One connection is kept open for the lifetime of the session. Transactions
+    are managed explicitly with transaction(), which can be nested: only the
+    outermost block commits (or rolls back on an exception). Statements are
+    compiled once per connection and reused from sqlite's statement cache, so
+    running the same query many times only binds new parameters.
+    """
+    def __init__(self, path, cached_statements=256):
+        self.path = path
+        self._depth = 0
+        #functions to call once the outermost transaction commits, see on_commit()
+        self._on_commit = []
+
+        self._connection = sqlite3.connect(path, cached_statements=cached_statements)
+        #we issue BEGIN/COMMIT ourselves
+        self._connection.isolation_level = None
+
+        try:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.OperationalError:
+            #WAL is not available on some file systems (network shares), the
+            #default rollback journal still works there
+            pass
+
+    def create(self):
+        """Create the tables of an empty manifest at the current schema version"""
+        with self.transaction():
+            _create_tables(self)
+            self.migrate()
+
+    def schema_version(self):
+        row = self.fetchone("SELECT name FROM sqlite_master "
+                            "WHERE type = 'table' AND name = 'schema_version'")
+        if row is None:
+            return 0
+        return self.fetchone("SELECT version FROM schema_version")[0]
+
+    def migrate(self):
+        """Upgrade the manifest in place to the current schema version"""
+        with self.transaction():
+            version = self.schema_version()
+            if version > SCHEMA_VERSION:
+                raise exceptions.BundleError("Bundle was created by a newer version of "
+                                             "CLbundler (schema version {0})".format(version))
+            for upgrade in _migrations[version:]:
+                upgrade(self)
+            if version != SCHEMA_VERSION:
+                self.execute("UPDATE schema_version SET version = ?", (SCHEMA_VERSION,))
+            
+    def intern_dirs(self, paths):
+        """Return a dict that maps each directory in paths to its id in the dirs table
+        
+        Directories that are not in the table yet are added.
+        """
+        paths = set(paths)
+        self.executemany("INSERT OR IGNORE INTO dirs (path) VALUES (?)", 
+                         ((p,) for p in paths))
+        return dict((p, self.fetchone("SELECT id FROM dirs WHERE path = ?", (p,))[0])
+                    for p in paths)
+            
+    def close(self):
+        if self._connection is not None:
+            if self._depth:
+                self._connection.execute("ROLLBACK")
+                self._depth = 0
+                self._on_commit = []
+            self._connection.close()
+            self._connection = None
+
+    def on_commit(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) after the outermost transaction commits
+        
+        Outside of a transaction, func is called right away. If the transaction
+        is rolled back, func is never called. Use it for changes outside the
+        database that must only happen if the manifest changes are kept.
+        """
+        if self._depth == 0:
+            func(*args, **kwargs)
+        else:
+            self._on_commit.append((func, args, kwargs))
+
+    @contextmanager
+    def transaction(self):
+        """Group all statements executed in the with block into one transaction"""
+        if self._depth == 0:
+            self._connection.execute("BEGIN IMMEDIATE")
+        self._depth += 1
+        try:
+            yield self
+        except:
+            self._depth -= 1
+            if self._depth == 0:
+                self._connection.execute("ROLLBACK")
+                self._on_commit = []
+            raise
+        else:
+            self._depth -= 1
+            if self._depth == 0:
+                self._connection.execute("COMMIT")
+                callbacks, self._on_commit = self._on_commit, []
+                for func, args, kwargs in callbacks:
+                    func(*args, **kwargs)
+
+    def execute(self, query, params=()):
+        return self._connection.execute(query, params)
+
+    def executemany(self, query, param_seq):
+        return self._connection.executemany(query, param_seq)
+
+    def fetchone(self, query, params=()):
+        return self._connection.execute(query, params).fetchone()
+
+    def fetchall(self, query, params=()):
+        return self._connection.execute(query, params).fetchall()
@@ -28,6 +28,10 @@ def patch_source(names, paths, src_dir):
     paths -- list of directories to search for patch files
     src_dir -- directory to apply patches in
     """
+    system.patch(find_patches(names, paths), src_dir)
+
+def find_patches(names, paths):
+    """Return the paths of the patch files for names (see patch_source())"""
     patches = []
     for n in names:
         patch = ""
@@ -40,5 +44,5 @@ def patch_source(names, paths, src_dir):
             
         patches.append(patch)
         
-    system.patch(patches, src_dir)
+    return patches
     
@@ -1,6 +1,8 @@
 import os
 import subprocess
 import logging
+import threading
+from contextlib import contextmanager
 
 from config import os_name
 import env
@@ -9,6 +11,9 @@ import fileutils
 
 _commands = {}
 
+#working directory and environment of the current build thread, see thread_dir()
+_local = threading.local()
+
 def find_cmd(name, env_path, search_orginal=True):
     if search_orginal:
         env_path = env_path + env.original_env["PATH"]
@@ -27,20 +32,61 @@ def unix_path(path):
         path = "/" + drive_letter[:-1] + path.replace("\\", "/")
     return path
     
-def run_cmd(name, args=[], silent=False, ignore_errors=False):
+def getcwd():
+    """Return the directory commands started by this thread run in"""
+    cwd = getattr(_local, "cwd", None)
+    if cwd is None:
+        return os.getcwd()
+    return cwd
+
+def chdir(path):
+    """
+    Change the directory commands started by this thread run in.
+    This is os.chdir(), unless the thread has its own directory (see thread_dir())
+    """
+    if getattr(_local, "cwd", None) is None:
+        os.chdir(path)
+    else:
+        _local.cwd = os.path.normpath(os.path.join(_local.cwd, path))
+
+@contextmanager
+def thread_dir(path, environ=None):
+    """
+    Give the current thread its own working directory (and environment) for the with block.
+    Builds running in parallel use this instead of os.chdir(), which changes the 
+    directory of the whole process. run_cmd(), getcwd() and chdir() use the thread's 
+    directory, but relative paths passed to other functions are still relative to 
+    the process' directory.
+    """
+    old = (getattr(_local, "cwd", None), getattr(_local, "env", None))
+    _local.cwd = os.path.abspath(path)
+    _local.env = environ
+    try:
+        yield
+    finally:
+        _local.cwd, _local.env = old
+
+def run_cmd(name, args=[], silent=False, ignore_errors=False, cwd=None):
     """
     Run an executable file.
     Like a normal shell, name can be a path or a command that can be found by searching PATH.
     Special characters in args are escaped by the subprocess module
     If silent is true, output is dumped to devnull
+    The command runs in cwd, or in getcwd() if cwd is not given
     """
-    if os.path.isfile(name):
-        file_path = name
+    if cwd is None:
+        cwd = getattr(_local, "cwd", None)
+    environ = getattr(_local, "env", None)
+    if environ is None:
+        environ = env.env
+    
+    if os.path.isfile(os.path.join(cwd or "", name)):
+        file_path = os.path.join(cwd or "", name)
     else:
         if not _commands.has_key(name):
             if os_name() == "win" and not os.path.splitext(name)[1]:
                 name = name + ".exe"
-            file_path = find_cmd(name, env.env["PATH"])
+            file_path = find_cmd(name, environ["PATH"])
             _commands[name] = file_path
         else:
             file_path = _commands[name]
@@ -51,9 +97,9 @@ def run_cmd(name, args=[], silent=False, ignore_errors=False):
         if silent:
             with open(os.devnull, 'wb') as devnull:
                 subprocess.check_call(cmd_line, stdout=devnull,
-                                      stderr=devnull, env=env.env)
+                                      stderr=devnull, env=environ, cwd=cwd)
         else:
-            subprocess.check_call(cmd_line, env=env.env)
+            subprocess.check_call(cmd_line, env=environ, cwd=cwd)
     except subprocess.CalledProcessError as e:
         if not ignore_errors:
             raise exceptions.CalledProcessError(e.returncode, e.cmd)
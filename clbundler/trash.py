@@ -0,0 +1,83 @@
+import os
+import errno
+import uuid
+import logging
+from multiprocessing.pool import ThreadPool
+
+import config
+import fileutils
+
+_trash = None
+
+def workspace_trash():
+    """Return the Trash in the workspace directory
+
+    The first call also schedules the deletion of anything left in the trash
+    by a previous process that did not finish.
+    """
+    global _trash
+
+    if _trash is None:
+        _trash = Trash(os.path.join(config.global_config().workspace_dir(), ".trash"))
+        _trash.purge()
+    return _trash
+
+def discard(path):
+    """Delete path in the background using the workspace trash"""
+    workspace_trash().discard(path)
+
+def wait():
+    """Wait until everything in the workspace trash has been deleted"""
+    if _trash is not None:
+        _trash.wait()
+
+class Trash(object):
+    """Deletes files and directories in the background
+
+    discard() renames a path into the trash directory, which is atomic and
+    fast, and a pool of worker threads deletes it later. If the process dies
+    first, the contents of the trash directory are deleted by purge().
+    """
+    def __init__(self, path, workers=4):
+        self.path = path
+        self._workers = workers
+        self._pool = None
+
+    def discard(self, path):
+        fileutils.makedirs(self.path, exist_ok=True)
+
+        target = os.path.join(self.path, "{0}-{1}".format(os.path.basename(path), uuid.uuid4().hex))
+        try:
+            os.rename(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            #the trash is on another file system, so there is nothing to gain
+            fileutils.remove(path)
+        else:
+            self._delete_later(target)
+
+    def purge(self):
+        """Schedule the deletion of everything in the trash directory"""
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                self._delete_later(os.path.join(self.path, name))
+
+    def wait(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _delete_later(self, path):
+        if self._pool is None:
+            self._pool = ThreadPool(self._workers)
+        self._pool.apply_async(_delete, (path,))
+
+def _delete(path):
+    try:
+        fileutils.remove(path)
+    except OSError as e:
+        #another process may be emptying the same trash
+        if e.errno != errno.ENOENT:
+            logging.getLogger().warning("Could not delete {0}: {1}".format(path, e))
@@ -0,0 +1,86 @@
+import os
+import sys
+import imp
+import shutil
+import py_compile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..")))
+from clbundler import buildcache, exceptions
+from clbundler.fileset import FileSet
+
+_formula_source = """from clbundler.formula import *
+class Sample(Formula):
+    def __init__(self, context, options={}):
+        super(Sample, self).__init__(context, options)
+        self.version = "1"
+"""
+
+class Context(object):
+    os_name = "linux"
+    toolchain = "gcc"
+    arch = "x64"
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "Sample.py")
+        with open(self.path, "w") as f:
+            f.write(_formula_source)
+    
+    def tearDown(self):
+        sys.modules.pop("Sample", None)
+        shutil.rmtree(self.dir)
+    
+    def _fingerprint(self):
+        module_info = imp.find_module("Sample", [self.dir])
+        try:
+            module = imp.load_module("Sample", *module_info)
+        finally:
+            module_info[0].close()
+        formula = module.Sample(Context())
+        self.assertEqual(formula.file, self.path)
+        return buildcache.fingerprint(formula, Context(), [], {})
+    
+    def test_compiled_formula(self):
+        first = self._fingerprint()
+        #the module is loaded from Sample.pyc now, and its __file__ is the .pyc
+        py_compile.compile(self.path)
+        sys.modules.pop("Sample", None)
+        self.assertEqual(first, self._fingerprint())
+
+class PutTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = buildcache.BuildCache(os.path.join(self.dir, "cache"), 1024 * 1024)
+        self.build = os.path.join(self.dir, "build")
+        os.makedirs(os.path.join(self.build, "lib"))
+        with open(os.path.join(self.build, "lib", "libfoo.so.1"), "w") as f:
+            f.write("foo")
+        os.symlink("libfoo.so.1", os.path.join(self.build, "lib", "libfoo.so"))
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def _fileset(self):
+        fs = FileSet()
+        fs.add([os.path.join(self.build, "lib", "*")], "lib")
+        return fs
+    
+    def test_restore(self):
+        self.cache.put("a" * 64, self._fileset())
+        dest = os.path.join(self.dir, "restored")
+        plan = self.cache.get("a" * 64, dest).resolve()
+        self.assertEqual(sorted(f[1] for f in plan.files), ["lib/libfoo.so", "lib/libfoo.so.1"])
+        self.assertEqual(os.readlink(os.path.join(dest, "run", "lib", "libfoo.so")), "libfoo.so.1")
+    
+    def test_absolute_link(self):
+        #get() would refuse the entry, so it is not stored at all
+        os.symlink(os.path.join(self.build, "lib", "libfoo.so.1"), 
+                   os.path.join(self.build, "lib", "libfoo.so.1.0"))
+        self.assertRaises(exceptions.BuildCacheError, self.cache.put, "b" * 64, self._fileset())
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..")))
+from clbundler.fileset import FileSet
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for path in ["lib/a.so", "lib/sub/b.h", "lib/sub/deep/c.h"]:
+            path = os.path.join(self.dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def _resolve(self, entries):
+        fs = FileSet()
+        for pattern, dest in entries:
+            fs.add([os.path.join(self.dir, pattern)], dest)
+        plan = fs.resolve()
+        return set(plan.dirs), set(plan.files)
+    
+    def test_doublestar_below_other_pattern(self):
+        #both patterns are matched in one walk of lib, which also reaches lib/sub itself
+        dirs, files = self._resolve([("lib/*", "lib"), ("lib/sub/**", "")])
+        parent_dirs, parent_files = self._resolve([("lib/*", "lib")])
+        sub_dirs, sub_files = self._resolve([("lib/sub/**", "")])
+        
+        self.assertNotIn("", dirs)
+        self.assertNotIn("", [dest for src, dest, category in files])
+        self.assertEqual(dirs, parent_dirs | sub_dirs)
+        self.assertEqual(files, parent_files | sub_files)
+
+if __name__ == "__main__":
+    unittest.main()
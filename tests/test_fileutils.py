@@ -0,0 +1,38 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..")))
+from clbundler import fileutils
+
+class GlobManyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for path in ["lib/a.so", "lib/sub/b.h", "lib/sub/deep/c.h", "include/d.h"]:
+            path = os.path.join(self.dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_same_as_glob(self):
+        #the ** patterns are below the roots of the other patterns, so they are
+        #matched in the walks of lib and of the temporary directory
+        patterns = [os.path.join(self.dir, p) for p in 
+                    ["lib/*", "lib/sub/**", "lib/sub/deep/**", "*/**/*.h", "include/**"]]
+        
+        matches = dict((i, set()) for i in range(len(patterns)))
+        for path, indices in fileutils.glob_many([(p, None) for p in patterns]):
+            for i in indices:
+                matches[i].add(path)
+        
+        for i, pattern in enumerate(patterns):
+            self.assertEqual(matches[i], set(fileutils.glob(pattern)), pattern)
+        self.assertNotIn(os.path.join(self.dir, "lib", "sub"), matches[1])
+
+if __name__ == "__main__":
+    unittest.main()
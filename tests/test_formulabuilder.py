@@ -0,0 +1,145 @@
+import os
+import sys
+import shutil
+import zipfile
+import optparse
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..")))
+from clbundler import config, formulamanager
+from clbundler.bundle import LibBundle
+from clbundler.formulabuilder import FormulaBuilder
+
+_formula_source = """from clbundler.formula import *
+class {name}(Formula):
+    def __init__(self, context, options={{}}):
+        super({name}, self).__init__(context, options)
+        self.version = "1"
+        self.source = {{"type":"archive", "url":"file:///nonexistent/{name}.zip"}}
+        self.supported = {{"gcc":["x64"]}}
+        self.depends_on = dict((n, {{}}) for n in {deps!r})
+    
+    def build(self):
+        with open(os.path.join(self.dir, "builds.log"), "a") as f:
+            f.write("{name}\\n")
+        with open(os.path.join(self.context.install_dir, "{name}.txt"), "w") as f:
+            f.write({content!r})
+        fs = FileSet()
+        fs.add([self.context.install_dir + "/*"], "lib")
+        return fs
+"""
+
+class InstallTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_config = dict((o, config.global_config().get("Paths", o)) 
+                               for o in ("workspace", "src_cache"))
+        config.global_config().set("Paths", "workspace", os.path.join(self.dir, "workspace"))
+        config.global_config().set("Paths", "src_cache", os.path.join(self.dir, "src_cache"))
+        if not config.global_config().has_section("BuildCache"):
+            config.global_config().add_section("BuildCache")
+        config.global_config().set("BuildCache", "max_size", "0")
+        os.makedirs(config.global_config().workspace_dir())
+        os.makedirs(config.global_config().src_cache_dir())
+        
+        self.formula_dir = os.path.join(self.dir, "formulas")
+        os.makedirs(self.formula_dir)
+        self._write_formula("DryRunA", [], "a")
+        self._write_formula("DryRunB", ["DryRunA"], "b")
+        for name in ("DryRunA", "DryRunB"):
+            with zipfile.ZipFile(os.path.join(config.global_config().src_cache_dir(), 
+                                              name + ".zip"), "w") as z:
+                z.writestr(name + "/README", name)
+        
+        self.bundle = LibBundle()
+        self.bundle.create(os.path.join(self.dir, "bundle"), "linux", "gcc", "x64")
+        self.cwd = os.getcwd()
+    
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.bundle.close()
+        self._forget_formulas()
+        for option, value in self.old_config.iteritems():
+            config.global_config().set("Paths", option, value)
+        config.global_config().remove_option("BuildCache", "max_size")
+        config.global_config().remove_option("BuildCache", "remote")
+        shutil.rmtree(self.dir)
+    
+    def _write_formula(self, name, deps, content):
+        with open(os.path.join(self.formula_dir, name + ".py"), "w") as f:
+            f.write(_formula_source.format(name=name, deps=deps, content=content))
+    
+    def _forget_formulas(self):
+        for name in ("DryRunA", "DryRunB"):
+            formulamanager._formula_cache.pop(name, None)
+            sys.modules.pop(name, None)
+    
+    def _install(self, name, **kwargs):
+        options = dict(force=False, interactive=False, clean_src=False, variant=None,
+                       install_mode=None, checksum=False, dry_run=False, no_cache=False, 
+                       update=False, jobs=1)
+        options.update(kwargs)
+        self._forget_formulas()
+        FormulaBuilder(self.bundle).install(os.path.join(self.formula_dir, name + ".py"),
+                                            optparse.Values(options))
+    
+    def _builds(self):
+        """Return the names of the formulas built since the last call"""
+        path = os.path.join(self.formula_dir, "builds.log")
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            names = f.read().split()
+        os.remove(path)
+        return names
+    
+    def _snapshot(self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.bundle.path):
+            for n in filenames:
+                if not n.startswith("MANIFEST.db"):
+                    path = os.path.join(dirpath, n)
+                    with open(path, "rb") as f:
+                        files[os.path.relpath(path, self.bundle.path)] = f.read()
+        packages = dict((name, (version, self.bundle.fingerprint(name), 
+                                sorted(self.bundle.list_files(name))))
+                        for name, version in self.bundle.list_installed())
+        return files, packages
+    
+    def test_update_dry_run_leaves_bundle_unchanged(self):
+        self._install("DryRunB")
+        self.assertEqual(self._builds(), ["DryRunA", "DryRunB"])
+        before = self._snapshot()
+        self.assertEqual(before[0]["lib/DryRunA.txt"], "a")
+        
+        #DryRunA and, through its fingerprint, DryRunB are outdated now
+        self._write_formula("DryRunA", [], "a2")
+        self._install("DryRunB", update=True, dry_run=True)
+        self.assertEqual(self._builds(), ["DryRunB"])
+        self.assertEqual(before, self._snapshot())
+        
+        self._install("DryRunB", update=True)
+        self.assertEqual(self._builds(), ["DryRunA", "DryRunB"])
+        self.assertEqual(self._snapshot()[0]["lib/DryRunA.txt"], "a2")
+    
+    def test_serial_install_prepares_once(self):
+        prepared = []
+        prepare = FormulaBuilder._prepare
+        def _prepare(builder, formula_name, **kwargs):
+            prepared.append(formula_name)
+            return prepare(builder, formula_name, **kwargs)
+        
+        #with a remote cache, the builds are prefetched before any is installed
+        config.global_config().set("BuildCache", "max_size", "100")
+        config.global_config().set("BuildCache", "remote", os.path.join(self.dir, "remote"))
+        FormulaBuilder._prepare = _prepare
+        try:
+            self._install("DryRunB")
+        finally:
+            FormulaBuilder._prepare = prepare
+        self.assertEqual(self._builds(), ["DryRunA", "DryRunB"])
+        self.assertEqual(sorted(prepared), ["DryRunA", "DryRunB"])
+
+if __name__ == "__main__":
+    unittest.main()